@@ -0,0 +1,173 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# asyncio streams of frames and audio, fed from the USB thread.
+#
+#   async for frame in cap.frames():
+#       ...
+#   async for chunk in cap.audio(maxsize=32, policy=aio.BLOCK):
+#       ...
+#
+# Every stream has its own bounded queue. The USB thread only ever appends
+# to it and wakes the event loop, so a slow coroutine loses frames (or
+# audio) rather than delaying the resubmission of transfers.
+
+import asyncio
+import collections
+import threading
+
+from framering import Frame
+
+# What to do with a new item when the queue is full
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+# Makes the producer wait for room. Never use this for a live capture, as
+# it stalls the USB thread: it's meant for replays that must not lose
+# anything (see replay.ReplayEasyCAP with realtime=False).
+BLOCK = "block"
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+# A bounded queue that is filled from any thread, and drained by a
+# coroutine on the given loop. If given, prepare is called on every item
+# that is queued, on the producer's thread.
+class Stream:
+    def __init__(
+        self,
+        loop: asyncio.AbstractEventLoop,
+        maxsize: int,
+        policy: str,
+        prepare=None,
+    ):
+        if maxsize < 1:
+            raise ValueError("Stream size must be at least 1, got %d" % maxsize)
+        if policy not in POLICIES:
+            raise ValueError("Unknown backpressure policy %s" % policy)
+
+        self.loop = loop
+        self.maxsize = maxsize
+        self.policy = policy
+        self.prepare = prepare
+        # Items thrown away because the queue was full
+        self.dropped = 0
+        # Frames thrown away because they were overwritten while queued
+        self.stale = 0
+        self.closed = False
+
+        self._items = collections.deque()
+        self._lock = threading.Condition()
+        # The future the consumer is waiting on, if any
+        self._waiter = None
+
+    # Called by the producer
+    def put(self, item):
+        with self._lock:
+            if self.closed:
+                return
+            if len(self._items) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return
+                elif self.policy == DROP_OLDEST:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self._items) >= self.maxsize and not self.closed:
+                        self._lock.wait()
+                    if self.closed:
+                        return
+            if self.prepare:
+                item = self.prepare(item)
+            self._items.append(item)
+            self._wake()
+
+    # Ends the stream once whatever is queued has been consumed
+    def close(self):
+        with self._lock:
+            self.closed = True
+            self._lock.notify_all()
+            self._wake()
+
+    def _wake(self):
+        # Only bother the loop if the consumer is actually waiting
+        waiter, self._waiter = self._waiter, None
+        if waiter is not None:
+            self.loop.call_soon_threadsafe(_set_done, waiter)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            with self._lock:
+                if self._items:
+                    item = self._items.popleft()
+                    # Let a blocked producer carry on
+                    self._lock.notify()
+                    return item
+                if self.closed:
+                    raise StopAsyncIteration
+                waiter = self._waiter = self.loop.create_future()
+            await waiter
+
+
+def _set_done(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+# Yields every completed Frame of the capture.
+#
+# Frames are views of the capture's FrameRing, which gets overwritten
+# (frame_buffers - 1) frames later. Frames that went stale while queued
+# are dropped rather than yielded. With copy set, frames are copied out
+# of the ring on the USB thread instead, so they never go stale.
+async def frames(cap, maxsize: int = 1, policy: str = DROP_OLDEST, copy: bool = False):
+    # Blocking is pointless if the ring overwrites queued frames anyway:
+    # it must hold the queue, the frame being consumed and the back buffer
+    if policy == BLOCK and not copy and cap.ring.count < maxsize + 2:
+        raise ValueError(
+            "Blocking on %d frames needs at least %d frame_buffers (or copy=True)"
+            % (maxsize, maxsize + 2)
+        )
+    stream = Stream(
+        asyncio.get_running_loop(), maxsize, policy, _copy_frame if copy else None
+    )
+    cap.attach_frame_consumer(stream)
+    try:
+        async for frame in stream:
+            if not copy and not cap.ring.is_intact(frame):
+                stream.stale += 1
+                continue
+            yield frame
+    finally:
+        cap.detach_frame_consumer(stream)
+
+
+def _copy_frame(frame: Frame) -> Frame:
+    return frame._replace(
+        data=memoryview(bytes(frame.data)),
+        dirty=None if frame.dirty is None else frame.dirty.copy(),
+    )
+
+
+# Yields every AudioChunk of the capture
+async def audio(cap, maxsize: int = 16, policy: str = DROP_OLDEST):
+    stream = Stream(asyncio.get_running_loop(), maxsize, policy)
+    cap.attach_audio_consumer(stream)
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        cap.detach_audio_consumer(stream)
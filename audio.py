@@ -0,0 +1,197 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Audio delivery, decoupled from the USB thread.
+#
+# The USB thread writes samples into a PCMRing as transfers complete, and
+# never waits for anything. A separate thread takes them out a period at a
+# time and hands them to the consumers, which can take as long as they
+# like: if they fall too far behind, the ring overruns and new samples are
+# dropped (and counted) rather than holding up the transfers.
+
+import collections
+import threading
+import time
+from typing import NamedTuple
+
+import numpy as np
+
+# 16 bit stereo at 48kHz (as in the Linux driver)
+AUDIO_SAMPLE_RATE = 48000
+AUDIO_CHANNELS = 2
+AUDIO_FRAME_SIZE = 2 * AUDIO_CHANNELS
+
+
+# A period of audio, as handed out to consumers
+class AudioChunk(NamedTuple):
+    # Interleaved 16 bit little endian samples
+    data: bytes
+    # When the first sample was captured (monotonic nanoseconds), worked
+    # out from when its transfer completed
+    timestamp: int
+    # Index of the first sample (frame) since the capture started
+    sample: int
+
+
+# A single producer, single consumer ring of bytes.
+#
+# The writer only ever moves write_index forward, and only after the data
+# is in place. The reader does the same with read_index. Each side only
+# reads the other's index, so neither needs a lock.
+class PCMRing:
+    def __init__(self, capacity: int):
+        # A power of two, so that wrapping around is a mask
+        self.capacity = 1 << (capacity - 1).bit_length()
+        self._mask = self.capacity - 1
+        self.buffer = np.zeros(self.capacity, dtype=np.uint8)
+        self.write_index = 0
+        self.read_index = 0
+
+    def available(self) -> int:
+        return self.write_index - self.read_index
+
+    def free(self) -> int:
+        return self.capacity - self.available()
+
+    # Returns False (and writes nothing) if there isn't room for all of it
+    def write(self, data) -> bool:
+        data = np.frombuffer(data, dtype=np.uint8)
+        count = len(data)
+        if count > self.free():
+            return False
+
+        start = self.write_index & self._mask
+        first = min(count, self.capacity - start)
+        self.buffer[start : start + first] = data[:first]
+        self.buffer[: count - first] = data[first:]
+        self.write_index += count
+        return True
+
+    # Takes count bytes out of the ring, which must be available
+    def read(self, count: int) -> bytes:
+        start = self.read_index & self._mask
+        first = min(count, self.capacity - start)
+        if first == count:
+            data = self.buffer[start : start + count].tobytes()
+        else:
+            data = (
+                self.buffer[start:].tobytes() + self.buffer[: count - first].tobytes()
+            )
+        self.read_index += count
+        return data
+
+
+# Runs the thread that delivers audio in chunks of period frames.
+#
+# deliver is called with an AudioChunk for every period. The thread polls
+# the ring rather than being woken up, so the USB thread never touches a
+# lock.
+class AudioDelivery:
+    def __init__(
+        self,
+        deliver,
+        counters,
+        period: int = 1024,
+        ring_size: int = 1 << 18,
+        sample_rate: int = AUDIO_SAMPLE_RATE,
+    ):
+        self.deliver = deliver
+        self.counters = counters
+        self.period = period
+        self.period_bytes = period * AUDIO_FRAME_SIZE
+        self.sample_rate = sample_rate
+        self.period_ns = period * 1000000000 // sample_rate
+        if ring_size < 2 * self.period_bytes:
+            raise ValueError("The audio ring must hold at least 2 periods")
+        self.ring = PCMRing(ring_size)
+        # (ring index just past the transfer, timestamp, frames dropped
+        # before it) of every transfer in the ring. Appending and popping
+        # from either end of a deque is atomic, so this needs no lock either.
+        self._marks = collections.deque(maxlen=self.ring.capacity // 16)
+        # Frames lost to overruns, so that sample indices still count every
+        # frame since the capture started. Only written by the USB thread.
+        self._dropped = 0
+
+        self.thread = None
+        self.running = False
+
+    # Called by the USB thread with every transfer's samples
+    def write(self, samples, timestamp: int):
+        if not self.ring.write(samples):
+            self.counters.audio_overruns += 1
+            self._dropped += len(samples) // AUDIO_FRAME_SIZE
+            return
+        self._marks.append((self.ring.write_index, timestamp, self._dropped))
+
+    # Takes count bytes out of the ring, and stamps them
+    def _read(self, count: int) -> AudioChunk:
+        start = self.ring.read_index
+        marks = self._marks
+        # Find the transfer the first sample came in
+        while len(marks) > 1 and marks[0][0] <= start:
+            marks.popleft()
+        timestamp = 0
+        dropped = 0
+        if marks:
+            end, completed, dropped = marks[0]
+            frames = (end - start) // AUDIO_FRAME_SIZE
+            timestamp = completed - frames * 1000000000 // self.sample_rate
+        return AudioChunk(
+            self.ring.read(count), timestamp, start // AUDIO_FRAME_SIZE + dropped
+        )
+
+    def start(self):
+        if self.thread:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # Stops the thread, once it has delivered whatever is left (ending
+    # with a shorter chunk)
+    def stop(self):
+        if not self.thread:
+            return
+        self.running = False
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def run(self):
+        ring = self.ring
+        counters = self.counters
+        # When the next period should be there by
+        deadline = None
+
+        while self.running:
+            if ring.available() >= self.period_bytes:
+                self.deliver(self._read(self.period_bytes))
+                counters.audio_periods += 1
+                now = time.monotonic_ns()
+                if deadline is None or deadline < now:
+                    deadline = now
+                # Allow for transfers landing on either side of a period
+                deadline += self.period_ns + self.period_ns // 2
+                continue
+
+            if deadline is not None and time.monotonic_ns() > deadline:
+                counters.audio_underruns += 1
+                deadline = None
+            time.sleep(self.period_ns / 4e9)
+
+        while ring.available() >= self.period_bytes:
+            self.deliver(self._read(self.period_bytes))
+            counters.audio_periods += 1
+        remaining = ring.available()
+        if remaining:
+            self.deliver(self._read(remaining))
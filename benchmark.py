@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmarks every stage of the capture and conversion pipeline on
+# synthetic, deterministic data built from test_images/.
+# Runs headless: no USB device, audio device or display is needed.
+#
+#   python benchmark.py [--frames N] [--stage NAME ...] [--json FILE]
+#                       [--trace FILE]
+
+import argparse
+import json
+import os
+import platform
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import synthetic
+import tracing
+from convert import Converter, Preview, luma, yuyv_to_ycbcr, deinterlace, frame
+from easycap import EASYCAP_FRAME_SIZE, EASYCAP_VIDEO_WIDTH, EASYCAP_VIDEO_HEIGHT
+from replay import ReplayEasyCAP
+
+# Bumped whenever the JSON output changes in an incompatible way
+RESULTS_VERSION = 1
+
+PERCENTILES = (50, 90, 99)
+
+
+def _cycle(items: list, count: int) -> list:
+    return [items[i % len(items)] for i in range(count)]
+
+
+# A single stage of the pipeline. setup() returns the list of arguments
+# the stage is called with, one call per iteration, and how many frames
+# and bytes each of those calls processes.
+class Stage:
+    name = None
+
+    def setup(self, framebuffers: list, frames: int):
+        raise NotImplementedError
+
+    def run(self, argument):
+        raise NotImplementedError
+
+    def teardown(self):
+        pass
+
+
+class BuildImagesStage(Stage):
+    name = "build_images"
+
+    def setup(self, framebuffers, frames):
+        # A replay device is never entered here, it is only used
+        # for its parsing code
+        self.cap = ReplayEasyCAP(None)
+        count = synthetic.transfers_per_frames(frames, empty_every=10)
+        stream = synthetic.transfers(framebuffers, empty_every=10)
+        arguments = [next(stream) for _ in range(count)]
+        return arguments, frames / count, arguments[0][0].nbytes
+
+    def run(self, argument):
+        self.cap.build_transfer(*argument)
+
+
+# The original packet-by-packet loop, on the same stream, for comparison
+class BuildImagesPythonStage(BuildImagesStage):
+    name = "build_images_python"
+
+    def setup(self, framebuffers, frames):
+        arguments, frames_per_call, bytes_per_call = super().setup(framebuffers, frames)
+        # Shaped like getISOBufferList and getISOSetupList
+        arguments = [
+            (
+                [bytearray(packet) for packet in packets],
+                [{"actual_length": length} for length in lengths],
+            )
+            for packets, lengths in arguments
+        ]
+        return arguments, frames_per_call, bytes_per_call
+
+    def run(self, argument):
+        self.cap._build_images_python(*argument)
+
+
+class YUYVToYCbCrStage(Stage):
+    name = "yuyv_to_ycbcr"
+
+    def setup(self, framebuffers, frames):
+        return _cycle(framebuffers, frames), 1, EASYCAP_FRAME_SIZE
+
+    def run(self, argument):
+        yuyv_to_ycbcr(argument)
+
+
+class DeinterlaceStage(Stage):
+    name = "deinterlace"
+
+    def setup(self, framebuffers, frames):
+        converted = [yuyv_to_ycbcr(framebuffer) for framebuffer in framebuffers]
+        return _cycle(converted, frames), 1, converted[0].nbytes
+
+    def run(self, argument):
+        deinterlace(argument)
+
+
+class FrameStage(Stage):
+    name = "frame"
+
+    def setup(self, framebuffers, frames):
+        return _cycle(framebuffers, frames), 1, EASYCAP_FRAME_SIZE
+
+    def run(self, argument):
+        frame(argument)
+
+
+# The direct YUYV to RGB path, into a preallocated output
+class ConverterStage(Stage):
+    name = "convert_rgb"
+
+    def setup(self, framebuffers, frames):
+        self.converter = Converter()
+        self.output = self.converter.allocate()
+        return _cycle(framebuffers, frames), 1, EASYCAP_FRAME_SIZE
+
+    def run(self, argument):
+        self.converter.convert(argument, self.output)
+
+
+# Grayscale only, into a preallocated output
+class LumaStage(Stage):
+    name = "luma"
+
+    def setup(self, framebuffers, frames):
+        self.output = np.empty(
+            (EASYCAP_VIDEO_HEIGHT, EASYCAP_VIDEO_WIDTH), dtype=np.uint8
+        )
+        return _cycle(framebuffers, frames), 1, EASYCAP_FRAME_SIZE
+
+    def run(self, argument):
+        luma(argument, output=self.output)
+
+
+# A quarter size thumbnail, box filtered
+class PreviewStage(Stage):
+    name = "preview"
+
+    def setup(self, framebuffers, frames):
+        self.preview = Preview(scale=4)
+        self.output = self.preview.allocate()
+        return _cycle(framebuffers, frames), 1, EASYCAP_FRAME_SIZE
+
+    def run(self, argument):
+        self.preview.convert(argument, self.output)
+
+
+class DisplayFrameStage(Stage):
+    name = "display_frame"
+
+    def setup(self, framebuffers, frames):
+        # Draw into an offscreen SDL window
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+        import pygame
+        import demo
+
+        pygame.init()
+        demo.screen = pygame.display.set_mode(
+            (EASYCAP_VIDEO_WIDTH, EASYCAP_VIDEO_HEIGHT)
+        )
+        self.clock = pygame.time.Clock()
+        self.demo = demo
+        self.pygame = pygame
+
+        converter = Converter()
+        # Kept alive for as long as the surfaces drawn from them
+        self.images = [converter.convert(buffer) for buffer in framebuffers]
+        surfaces = [demo.frame_surface(image) for image in self.images]
+        return _cycle(surfaces, frames), 1, EASYCAP_FRAME_SIZE
+
+    def run(self, argument):
+        self.demo.display_frame(argument, True, True, self.clock)
+
+    def teardown(self):
+        self.pygame.quit()
+
+
+STAGES = [
+    BuildImagesStage,
+    BuildImagesPythonStage,
+    YUYVToYCbCrStage,
+    DeinterlaceStage,
+    FrameStage,
+    ConverterStage,
+    LumaStage,
+    PreviewStage,
+    DisplayFrameStage,
+]
+
+
+# Percentiles, mean and max of a list of nanosecond latencies, in ms
+def _latency_summary(latencies) -> dict:
+    summary = {
+        "p%d" % percentile: float(np.percentile(latencies, percentile)) / 1e6
+        for percentile in PERCENTILES
+    }
+    summary["mean"] = float(np.mean(latencies)) / 1e6
+    summary["max"] = float(np.max(latencies)) / 1e6
+    return summary
+
+
+def run_stage(stage: Stage, framebuffers: list, frames: int, warmup: int) -> dict:
+    arguments, frames_per_call, bytes_per_call = stage.setup(framebuffers, frames)
+
+    for argument in arguments[:warmup]:
+        stage.run(argument)
+
+    latencies = np.empty(len(arguments), dtype=np.int64)
+    total_start = time.perf_counter_ns()
+    for i, argument in enumerate(arguments):
+        start = time.perf_counter_ns()
+        stage.run(argument)
+        latencies[i] = time.perf_counter_ns() - start
+    total = (time.perf_counter_ns() - total_start) / 1e9
+
+    # Tracing allocations slows everything down,
+    # so peak memory is measured in a separate pass
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for argument in arguments[: max(warmup, 1)]:
+        stage.run(argument)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+
+    stage.teardown()
+
+    return {
+        "calls": len(arguments),
+        "frames_per_second": len(arguments) * frames_per_call / total,
+        "megabytes_per_second": len(arguments) * bytes_per_call / total / 1e6,
+        "latency_ms": _latency_summary(latencies),
+        "peak_memory_bytes": peak,
+    }
+
+
+# Replays a whole synthetic capture file, as fast as possible, through a
+# ReplayEasyCAP. This covers reading the file as well as parsing.
+def run_replay(framebuffers: list, frames: int) -> dict:
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "benchmark.cap")
+        synthetic.write_capture(path, framebuffers, frames, empty_every=10)
+
+        completed = []
+        cap = ReplayEasyCAP(path, realtime=False)
+        cap.frame_handler = lambda frame: completed.append(time.perf_counter_ns())
+        start = time.perf_counter_ns()
+        with cap:
+            cap.wait()
+        total = (time.perf_counter_ns() - start) / 1e9
+        size = os.path.getsize(path)
+
+    intervals = np.diff([start] + completed)
+    return {
+        "calls": len(completed),
+        "frames_per_second": len(completed) / total,
+        "megabytes_per_second": size / total / 1e6,
+        "latency_ms": _latency_summary(intervals),
+        "peak_memory_bytes": None,
+    }
+
+
+def print_results(results: dict):
+    print(
+        "%-20s %10s %10s %9s %9s %9s %9s %12s"
+        % ("stage", "frames/s", "MB/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "peak mem")
+    )
+    for name, result in results["stages"].items():
+        if "error" in result:
+            print("%-20s skipped: %s" % (name, result["error"]))
+            continue
+        latency = result["latency_ms"]
+        peak = result["peak_memory_bytes"]
+        print(
+            "%-20s %10.1f %10.1f %9.3f %9.3f %9.3f %9.3f %12s"
+            % (
+                name,
+                result["frames_per_second"],
+                result["megabytes_per_second"],
+                latency["p50"],
+                latency["p90"],
+                latency["p99"],
+                latency["max"],
+                "-" if peak is None else "%.1f KiB" % (peak / 1024),
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the capture and conversion pipeline"
+    )
+    parser.add_argument("--frames", type=int, default=90, help="frames per stage")
+    parser.add_argument("--warmup", type=int, default=5, help="untimed calls per stage")
+    parser.add_argument(
+        "--stage",
+        action="append",
+        choices=[stage.name for stage in STAGES] + ["replay"],
+        help="only run this stage (can be repeated)",
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument(
+        "--trace", help="also write a Chrome trace of every stage to this file"
+    )
+    args = parser.parse_args()
+    if args.trace:
+        tracing.start()
+
+    framebuffers = [
+        synthetic.image_to_framebuffer(path) for path in synthetic.test_images()
+    ]
+
+    results = {
+        "version": RESULTS_VERSION,
+        "time": time.time(),
+        "frames": args.frames,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "stages": {},
+    }
+    for stage in STAGES:
+        if args.stage and stage.name not in args.stage:
+            continue
+        try:
+            result = run_stage(stage(), framebuffers, args.frames, args.warmup)
+        except ImportError as e:
+            # e.g. pygame isn't installed
+            result = {"error": str(e)}
+        results["stages"][stage.name] = result
+    if not args.stage or "replay" in args.stage:
+        results["stages"]["replay"] = run_replay(framebuffers, args.frames)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.trace:
+        tracing.stop().dump(args.trace)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# The command line, run as python -m easycap:
+#
+#   python -m easycap capture --frames 300 --format y4m --audio out.wav
+#   python -m easycap capture --frames 10 --format png -o frame-%03d.png
+#   python -m easycap capture --benchmark --frames 900
+#
+# Grabbing frames on a headless box shouldn't need a display, an audio
+# output or an image library, so nothing is imported until the command
+# needs it: capturing to raw or y4m takes usb1 and numpy, png adds PIL.
+#
+# --replay reads a capture file (see replay.py) instead of a device.
+
+import argparse
+import threading
+import time
+
+FORMATS = ("raw", "y4m", "png")
+
+_DEFAULT_OUTPUTS = {
+    "raw": "capture.yuyv",
+    "y4m": "capture.y4m",
+    "png": "frame-%06d.png",
+}
+
+
+# Watches the frames go by, for the time to the first one and the rate
+class _Watch:
+    def __init__(self, frames: int = None):
+        self.frames = frames
+        self.count = 0
+        self.first = None
+        self.last = None
+        self.finished = threading.Event()
+
+    def put(self, frame):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.count += 1
+        if self.count == self.frames:
+            self.finished.set()
+
+    def close(self):
+        self.finished.set()
+
+    # Frames per second, from the first frame to the last
+    def rate(self) -> float:
+        if self.count < 2 or self.last == self.first:
+            return 0.0
+        return (self.count - 1) / (self.last - self.first)
+
+
+def _open(args):
+    if args.replay:
+        from replay import ReplayEasyCAP
+
+        return ReplayEasyCAP(args.replay, standard=args.standard)
+
+    from easycap import EasyCAP
+
+    return EasyCAP(standard=args.standard, input=args.input)
+
+
+def _sink(args, cap):
+    from recording import PNGSink, RawSink, Y4MSink
+
+    output = args.output or _DEFAULT_OUTPUTS[args.format]
+    if args.format == "raw":
+        return RawSink(output, size=cap.size)
+    if args.format == "y4m":
+        return Y4MSink(output, standard=cap.standard)
+    return PNGSink(output, size=cap.size)
+
+
+# Waits for the event, or for a replay to run out, or for ^C
+def _wait(event: threading.Event, cap):
+    try:
+        while not event.wait(0.1):
+            if getattr(cap, "finished", False):
+                break
+    except KeyboardInterrupt:
+        pass
+
+
+def capture(args, started: float):
+    cap = _open(args)
+    watch = _Watch(args.frames)
+    cap.attach_frame_consumer(watch)
+
+    recorder = None
+    if not args.benchmark:
+        from recording import Recorder
+
+        recorder = Recorder(
+            cap, _sink(args, cap), args.audio, buffers=args.buffers, frames=args.frames
+        )
+        recorder.start()
+
+    with cap:
+        _wait(recorder.finished if recorder else watch.finished, cap)
+        if recorder:
+            recorder.stop()
+        stats = cap.stats()
+
+    if watch.first is None:
+        print("No frames captured")
+        return 1
+    print(
+        "first frame after %.0f ms (from loading easycap, so with its imports "
+        "but not interpreter startup)" % ((watch.first - started) * 1000)
+    )
+    print("%d frames at %.2f fps" % (watch.count, watch.rate()))
+    print(
+        "%d incomplete (%d packets missing), %d frame counter gaps"
+        % (
+            stats["frames_incomplete"],
+            stats["packets_missing"],
+            stats["frame_counter_gaps"],
+        )
+    )
+    if recorder:
+        recorded = recorder.stats()
+        print(
+            "%d frames written, %d dropped, %d audio chunks dropped"
+            % (
+                recorded["frames_written"],
+                recorded["frames_dropped"],
+                recorded["audio_dropped"],
+            )
+        )
+    elif stats["iso_callback"]["count"]:
+        print(
+            "USB callback: mean %.0f us, max %.0f us"
+            % (stats["iso_callback"]["mean_us"], stats["iso_callback"]["max_us"])
+        )
+    return 0
+
+
+# started is a time.perf_counter() from as early on as possible, which the
+# time to the first frame is measured from
+def main(argv: list = None, started: float = None) -> int:
+    if started is None:
+        started = time.perf_counter()
+    parser = argparse.ArgumentParser(prog="python -m easycap")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    parser_capture = commands.add_parser(
+        "capture", help="capture frames (and audio) to files"
+    )
+    parser_capture.add_argument(
+        "--frames", type=int, default=300, help="number of frames to capture"
+    )
+    parser_capture.add_argument("--format", choices=FORMATS, default="y4m")
+    parser_capture.add_argument(
+        "-o",
+        "--output",
+        help="file to write, or for png, file name with a %%d for the frame number",
+    )
+    parser_capture.add_argument("--audio", metavar="WAV", help="also record audio")
+    parser_capture.add_argument(
+        "--benchmark",
+        action="store_true",
+        help="write nothing, only report the frame rate and drops",
+    )
+    parser_capture.add_argument(
+        "--buffers",
+        type=int,
+        default=8,
+        help="frames that can wait to be written before frames are dropped",
+    )
+    parser_capture.add_argument("--standard", default="NTSC")
+    parser_capture.add_argument("--input", default="Composite")
+    parser_capture.add_argument(
+        "--replay", metavar="FILE", help="read a capture file instead of a device"
+    )
+
+    args = parser.parse_args(argv)
+    return capture(args, started)
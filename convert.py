@@ -0,0 +1,598 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Conversion of raw framebuffers into something displayable.
+# None of this needs a display or an audio device.
+
+import numpy as np
+
+from tracing import traced
+
+# Converts a YUYV framebuffer into a YCbCr framebuffer
+@traced("yuyv_to_ycbcr")
+def yuyv_to_ycbcr(framebuffer):
+    # Group into 4 byte chunks (-1 means "until the end")
+    yuyv = np.reshape(framebuffer, (-1, 4))
+
+    # Y1 U Y2 V
+    # to
+    # Y1 U V Y2 U V
+    ycbcr = np.column_stack((
+        (yuyv[:, 0], yuyv[:, 1], yuyv[:, 3], yuyv[:, 2], yuyv[:, 1], yuyv[:, 3])
+    ))
+
+    return ycbcr.flatten()
+
+DEINTERLACE_MODES = ("weave", "bob", "linear", "field")
+
+
+# Fills output from the rows of a framebuffer laid out in field order
+# (first field, holding the odd lines, then the second field, holding the
+# even lines), which is what the device sends:
+#
+#   weave:  both fields interleaved, a full frame at the frame rate
+#   bob:    a single field, every line doubled, for output at field rate
+#   linear: a single field, missing lines interpolated from their neighbours
+#   field:  a single field on its own, at half height
+#
+# The single field modes use the given field (0 or 1).
+# average is a preallocated scratch array (half height, row size) of a type
+# wide enough to add two rows together, only used in "linear" mode.
+def _deinterlace_rows(rows, output, mode, field, average=None):
+    if mode not in DEINTERLACE_MODES:
+        raise ValueError("Unknown deinterlacing mode: %s" % mode)
+    half_height = len(rows) // 2
+
+    if mode == "weave":
+        yield output[1::2], rows[:half_height]
+        yield output[0::2], rows[half_height:]
+        return
+
+    lines = rows[field * half_height : (field + 1) * half_height]
+    if mode == "field":
+        yield output, lines
+        return
+
+    # Field 0 lands on the odd lines, field 1 on the even ones
+    if field == 0:
+        own, other = output[1::2], output[0::2]
+    else:
+        own, other = output[0::2], output[1::2]
+    yield own, lines
+
+    if mode == "bob":
+        # Every missing line repeats the line above it (or below, on the
+        # edge), so that both fields end up in the same place
+        if field == 0:
+            yield other[:1], lines[:1]
+            yield other[1:], lines[:-1]
+        else:
+            yield other, lines
+        return
+
+    if mode == "linear":
+        # Every missing line is the average of the lines above and below,
+        # except on the edge, where there is only one of them
+        np.add(lines[:-1], lines[1:], out=average[:-1], dtype=average.dtype)
+        np.add(average[:-1], 1, out=average[:-1])
+        np.right_shift(average[:-1], 1, out=average[:-1])
+        if field == 0:
+            yield other[:1], lines[:1]
+            yield other[1:], average[:-1]
+        else:
+            yield other[:-1], average[:-1]
+            yield other[-1:], lines[-1:]
+
+
+# Deinterlaces the framebuffer (any number of bytes per pixel), see
+# _deinterlace_rows for the available modes.
+# If given, output must be a preallocated array of the right size. So must
+# average, a (height / 2, row size) uint16 scratch array for "linear" mode:
+# callers that deinterlace often keep one of their own, rather than have
+# one allocated on every call. It must not be shared between threads.
+@traced("deinterlace")
+def deinterlace(
+    framebuffer, size=(720, 480), mode="weave", field=1, output=None, average=None
+):
+    # It's easier to work with when it's reshaped into a 2D array
+    rows = np.reshape(framebuffer, (size[1], -1))
+
+    height = size[1] // 2 if mode == "field" else size[1]
+    if output is None:
+        output = np.empty((height, rows.shape[1]), dtype=rows.dtype)
+    else:
+        output = np.reshape(output, (height, rows.shape[1]))
+
+    if mode == "linear" and average is None:
+        average = np.empty((size[1] // 2, rows.shape[1]), dtype=np.uint16)
+    for target, source in _deinterlace_rows(rows, output, mode, field, average):
+        np.copyto(target, source, casting="unsafe")
+
+    return output.reshape(-1)
+
+# The luma (Y plane) of a framebuffer, deinterlaced (see
+# _deinterlace_rows) into a (height, width) uint8 array, e.g. for motion
+# detection. The Y samples are read through a strided view, so chroma is
+# never touched. If given, output (and average, see deinterlace) must be
+# preallocated arrays of the right size.
+def luma(
+    framebuffer, size=(720, 480), mode="weave", field=1, output=None, average=None
+):
+    width, height = size
+    rows = np.frombuffer(framebuffer, dtype=np.uint8).reshape(height, width * 2)
+    deinterlaced = deinterlace(rows[:, 0::2], size, mode, field, output, average)
+    return deinterlaced.reshape(-1, width)
+
+
+# Converts the raw framebuffer into a PIL image
+@traced("frame")
+def frame(framebuffer, size = (720, 480)):
+    from PIL import Image
+
+    framebuffer = yuyv_to_ycbcr(framebuffer)
+    
+    framebuffer = deinterlace(framebuffer, size)
+    
+    im = Image.frombuffer(
+        "YCbCr", size, framebuffer, "raw", "YCbCr", 0, 1
+    )
+    im = im.convert("RGB")
+    
+    return im
+
+
+# Turns a frame's dirty mask (one entry per 960 byte packet, see
+# framering.Frame) into a mask of the lines that changed, in the same
+# (field) order as the framebuffer
+def dirty_lines(dirty, size=(720, 480)) -> np.ndarray:
+    width, height = size
+    line = width * 2
+    packet = line * height // len(dirty)
+    starts = np.arange(height) * line
+    first = starts // packet
+    last = (starts + line - 1) // packet
+    # A line is dirty if any packet it overlaps is
+    counts = np.concatenate(([0], np.cumsum(dirty)))
+    return counts[last + 1] > counts[first]
+
+
+# Dirty lines closer together than this are converted in one go
+_SPAN_GAP = 8
+# Past this fraction of dirty lines, the whole frame is converted
+_SPAN_LIMIT = 0.75
+
+
+# Fixed point precision of the conversion below. With 5 fractional bits,
+# every per-pixel value fits in 16 bits, even for out of range input.
+# The coefficients themselves are applied with more precision first.
+_SHIFT = 5
+_LUMA_SHIFT = 7
+_CHROMA_SHIFT = 12
+
+# BT.601 YCbCr to RGB coefficients: Cr->R, Cb->G, Cr->G, Cb->B
+_BT601 = (1.402, -0.344136, -0.714136, 1.772)
+
+# Channel order of every output format. -1 is an opaque alpha channel.
+FORMATS = {
+    "RGB": (0, 1, 2),
+    "BGR": (2, 1, 0),
+    "RGBA": (0, 1, 2, -1),
+    "BGRA": (2, 1, 0, -1),
+}
+
+
+# Converts raw YUYV framebuffers straight into packed RGB (or BGR, RGBA...),
+# deinterlacing on the way (see _deinterlace_rows for the modes).
+# In the single field modes, only the rows of that field are converted.
+#
+# All the arithmetic is done in 16 bit fixed point, in scratch arrays
+# allocated once, and the result is written into a caller-supplied array
+# of shape (height, width, channels).
+#
+# Limited range (Y 16-235, chroma 16-240) is what the device sends.
+# Full range (everything 0-255) is what JPEG and PIL's YCbCr mode use.
+#
+# In the "weave" and "field" modes, an output that already holds the
+# previous frame can be brought up to date by converting only the lines
+# that changed (see dirty_lines).
+class Converter:
+    def __init__(
+        self,
+        size=(720, 480),
+        format: str = "RGB",
+        full_range: bool = False,
+        deinterlace: str = "weave",
+    ):
+        if format not in FORMATS:
+            raise ValueError("Unknown format: %s" % format)
+        if deinterlace not in DEINTERLACE_MODES:
+            raise ValueError("Unknown deinterlacing mode: %s" % deinterlace)
+
+        self.size = size
+        self.format = format
+        self.full_range = full_range
+        self.deinterlace = deinterlace
+        self.channels = FORMATS[format]
+
+        width, height = size
+        if full_range:
+            y_scale, y_offset, c_scale = 1.0, 0, 1.0
+        else:
+            y_scale, y_offset, c_scale = 255 / 219, 16, 255 / 224
+
+        # The rounding term is folded into the luma offset
+        self._y_scale = round(y_scale * (1 << _LUMA_SHIFT))
+        self._y_offset = round((-y_offset * y_scale + 0.5) * (1 << _SHIFT))
+        self._cr_r, self._cb_g, self._cr_g, self._cb_b = (
+            round(c * c_scale * (1 << _CHROMA_SHIFT)) for c in _BT601
+        )
+
+        # Scratch space, in the framebuffer's (field) row order
+        self._luma_wide = np.empty((height, width), dtype=np.uint16)
+        self._luma = np.empty((height, width), dtype=np.int16)
+        self._cb = np.empty((height, width // 2), dtype=np.int16)
+        self._cr = np.empty((height, width // 2), dtype=np.int16)
+        self._chroma_wide = np.empty((height, width // 2), dtype=np.int32)
+        self._scratch = np.empty((height, width // 2), dtype=np.int32)
+        self._chroma = np.empty((height, width // 2), dtype=np.int16)
+        self._channel = np.empty((height, width), dtype=np.int16)
+        self._average = np.empty((height // 2, width), dtype=np.int16)
+
+    def allocate(self) -> np.ndarray:
+        width, height = self.size
+        if self.deinterlace == "field":
+            height //= 2
+        return np.empty((height, width, len(self.channels)), dtype=np.uint8)
+
+    # Computes one of the R, G or B chroma terms for the first count rows
+    def _chroma_term(self, component: int, count: int) -> np.ndarray:
+        cb, cr = self._cb[:count], self._cr[:count]
+        wide, chroma = self._chroma_wide[:count], self._chroma[:count]
+        if component == 0:
+            np.multiply(cr, self._cr_r, out=wide, dtype=np.int32)
+        elif component == 1:
+            np.multiply(cb, self._cb_g, out=wide, dtype=np.int32)
+            np.multiply(cr, self._cr_g, out=self._scratch[:count], dtype=np.int32)
+            np.add(wide, self._scratch[:count], out=wide)
+        else:
+            np.multiply(cb, self._cb_b, out=wide, dtype=np.int32)
+        np.right_shift(wide, _CHROMA_SHIFT - _SHIFT, out=chroma, casting="unsafe")
+        return chroma
+
+    # Fills the luma and chroma scratch arrays from rows of YUYV
+    def _load(self, yuyv: np.ndarray) -> int:
+        count = len(yuyv)
+        luma = self._luma[:count]
+        luma_wide = self._luma_wide[:count]
+        np.multiply(yuyv[:, 0::2], self._y_scale, out=luma_wide, dtype=np.uint16)
+        np.right_shift(luma_wide, _LUMA_SHIFT - _SHIFT, out=luma, casting="unsafe")
+        np.add(luma, self._y_offset, out=luma)
+        np.subtract(yuyv[:, 1::4], 128, out=self._cb[:count], dtype=np.int16)
+        np.subtract(yuyv[:, 3::4], 128, out=self._cr[:count], dtype=np.int16)
+        return count
+
+    # Computes one of the R, G or B channels of the loaded rows
+    def _channel_rows(self, component: int, count: int, channel: np.ndarray):
+        luma = self._luma[:count]
+        # Both pixels of a pair share their chroma
+        chroma = self._chroma_term(component, count)
+        np.add(luma[:, 0::2], chroma, out=channel[:, 0::2])
+        np.add(luma[:, 1::2], chroma, out=channel[:, 1::2])
+        np.right_shift(channel, _SHIFT, out=channel)
+
+    # Converts the framebuffer into output. The single field modes use the
+    # given field (0 or 1), e.g. from EasyCAP.field_handler.
+    #
+    # With dirty (a mask of lines, see dirty_lines) given, output must hold
+    # the conversion of the previous frame, and only the dirty lines are
+    # converted again.
+    @traced("convert")
+    def convert(
+        self, framebuffer, output: np.ndarray = None, field: int = 1, dirty=None
+    ) -> np.ndarray:
+        width, height = self.size
+        yuyv = np.frombuffer(framebuffer, dtype=np.uint8).reshape(height, width * 2)
+
+        # Everything below works on the rows that are actually needed
+        if self.deinterlace == "weave":
+            rows = slice(0, height)
+        else:
+            rows = slice(field * height // 2, (field + 1) * height // 2)
+
+        if output is None:
+            output = self.allocate()
+        elif dirty is not None and self.deinterlace in ("weave", "field"):
+            spans = self._dirty_spans(dirty, rows)
+            if spans is not None:
+                for start, end in spans:
+                    self._convert_span(yuyv, start, end, output)
+                return output
+
+        yuyv = yuyv[rows]
+        count = self._load(yuyv)
+        channel = self._channel[rows]
+
+        for index, component in enumerate(self.channels):
+            if component == -1:
+                output[:, :, index] = 255
+                continue
+
+            self._channel_rows(component, count, channel)
+            if self.deinterlace == "linear":
+                # Interpolate between the final values
+                np.clip(channel, 0, 255, out=channel)
+
+            # Clamping and narrowing to 8 bits writes straight into the
+            # deinterlaced output
+            targets = _deinterlace_rows(
+                self._channel,
+                output[:, :, index],
+                self.deinterlace,
+                field,
+                self._average,
+            )
+            for target, source in targets:
+                np.clip(source, 0, 255, out=target, casting="unsafe")
+
+        return output
+
+    # The (start, end) framebuffer rows to convert for the given dirty
+    # lines, or None if it's quicker to convert them all. Spans never
+    # cross from one field into the other.
+    def _dirty_spans(self, dirty, rows: slice) -> list:
+        dirty = np.asarray(dirty, dtype=bool)[rows]
+        if np.count_nonzero(dirty) > _SPAN_LIMIT * len(dirty):
+            return None
+
+        edges = np.flatnonzero(np.diff(dirty, prepend=False, append=False))
+        starts = edges[0::2] + rows.start
+        ends = edges[1::2] + rows.start
+        half = self.size[1] // 2
+
+        spans = []
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if spans and start - spans[-1][1] < _SPAN_GAP and start != half:
+                spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+        # Merging might have joined the two fields
+        split = []
+        for start, end in spans:
+            if start < half < end:
+                split += [(start, half), (half, end)]
+            else:
+                split.append((start, end))
+        return split
+
+    # Converts framebuffer rows start to end (in one field) into their
+    # lines of the output
+    def _convert_span(self, yuyv: np.ndarray, start: int, end: int, output):
+        count = self._load(yuyv[start:end])
+        channel = self._channel[:count]
+
+        half = self.size[1] // 2
+        field = start // half
+        line = start - field * half
+        if self.deinterlace == "field":
+            target = output[line : line + count]
+        else:
+            # Field 0 lands on the odd lines, field 1 on the even ones
+            first = 2 * line + (1 - field)
+            target = output[first : first + 2 * count : 2]
+
+        for index, component in enumerate(self.channels):
+            if component == -1:
+                target[:, :, index] = 255
+                continue
+            self._channel_rows(component, count, channel)
+            np.clip(channel, 0, 255, out=target[:, :, index], casting="unsafe")
+
+
+# Keeps an image up to date with the frames of a capture, reconverting
+# only the lines that changed since the frame before (see Frame.dirty),
+# and nothing at all for frames identical to the one before
+class LiveImage:
+    def __init__(self, converter: Converter):
+        self.converter = converter
+        self.image = converter.allocate()
+        # The sequence number of the frame in the image
+        self.sequence = None
+
+    # Brings the image up to date with the frame. Returns whether the
+    # image changed.
+    def update(self, frame) -> bool:
+        if frame.sequence == self.sequence:
+            return False
+        # The dirty mask is only good for going from the frame before
+        follows = self.sequence is not None and frame.sequence == self.sequence + 1
+        self.sequence = frame.sequence
+
+        if follows and frame.dirty is not None:
+            if not frame.dirty.any():
+                return False
+            lines = dirty_lines(frame.dirty, self.converter.size)
+            self.converter.convert(frame.data, self.image, dirty=lines)
+        else:
+            self.converter.convert(frame.data, self.image)
+        return True
+
+
+PREVIEW_SCALES = (1, 2, 4, 8)
+PREVIEW_FILTERS = ("box", "nearest")
+
+
+# A downscaled (1/2, 1/4 or 1/8) and/or cropped output, computed straight
+# from the YUYV framebuffer. Only the lines and columns inside roi are
+# ever read, and everything is allocated up front.
+#
+# roi is (x, y, width, height) in the full frame, with x and y even, and
+# width and height multiples of the scale (and of 2). At scale 1 the crop
+# is woven from both fields, as Converter does. Scaled down, every output
+# pixel is the average of a scale x scale block of the frame ("box"), or
+# its top left pixel ("nearest"); either way lines of both fields are
+# used, and chroma is never upsampled.
+class Preview:
+    def __init__(
+        self,
+        size=(720, 480),
+        scale: int = 2,
+        roi=None,
+        format: str = "RGB",
+        full_range: bool = False,
+        filter: str = "box",
+    ):
+        if scale not in PREVIEW_SCALES:
+            raise ValueError("Unknown scale: 1/%d" % scale)
+        if format not in FORMATS:
+            raise ValueError("Unknown format: %s" % format)
+        if filter not in PREVIEW_FILTERS:
+            raise ValueError("Unknown filter: %s" % filter)
+
+        frame_width, frame_height = size
+        x, y, width, height = roi or (0, 0, frame_width, frame_height)
+        step = max(scale, 2)
+        if (
+            x < 0
+            or y < 0
+            or x + width > frame_width
+            or y + height > frame_height
+            or width <= 0
+            or height <= 0
+        ):
+            raise ValueError("%r doesn't fit in a %dx%d frame" % (roi, *size))
+        if x % 2 or y % 2 or width % step or height % step:
+            raise ValueError(
+                "%r isn't aligned: x and y must be even, width and height "
+                "multiples of %d" % (roi, step)
+            )
+
+        self.size = size
+        self.scale = scale
+        self.roi = (x, y, width, height)
+        self.format = format
+        self.filter = filter
+        self.channels = FORMATS[format]
+        self.output_size = (width // scale, height // scale)
+
+        if full_range:
+            self._y_scale, self._y_offset, c_scale = 1.0, 0.0, 1.0
+        else:
+            self._y_scale, self._y_offset, c_scale = 255 / 219, 16.0, 255 / 224
+        self._cr_r, self._cb_g, self._cr_g, self._cb_b = (
+            c * c_scale for c in _BT601
+        )
+
+        # Where the crop is in each field: even lines come from the second
+        # field, odd lines from the first
+        half = frame_height // 2
+        columns = slice(2 * x, 2 * (x + width))
+        self._even = (slice(half + y // 2, half + (y + height) // 2), columns)
+        self._odd = (slice(y // 2, (y + height) // 2), columns)
+
+        out_width, out_height = self.output_size
+        shape = (out_height, out_width)
+        self._y = np.empty(shape, dtype=np.float32)
+        self._cb = np.empty(shape, dtype=np.float32)
+        self._cr = np.empty(shape, dtype=np.float32)
+        self._term = np.empty(shape, dtype=np.float32)
+        self._channel = np.empty(shape, dtype=np.float32)
+        # Sums of the lines, then of the whole blocks (at most 255 * 8 * 8)
+        if scale > 1 and filter == "box":
+            self._rows = np.empty((out_height, 2 * width), dtype=np.uint16)
+            self._sums = np.empty(shape, dtype=np.uint16)
+
+    def allocate(self) -> np.ndarray:
+        width, height = self.output_size
+        return np.empty((height, width, len(self.channels)), dtype=np.uint8)
+
+    # Loads the Y, Cb and Cr planes of the output from the framebuffer
+    def _load(self, framebuffer):
+        frame_width, frame_height = self.size
+        rows = np.frombuffer(framebuffer, dtype=np.uint8).reshape(
+            frame_height, frame_width * 2
+        )
+        even, odd = rows[self._even], rows[self._odd]
+        scale = self.scale
+
+        if scale == 1:
+            # Weave, with both pixels of a pair sharing their chroma
+            for field, lines in ((even, 0), (odd, 1)):
+                np.copyto(self._y[lines::2], field[:, 0::2])
+                for plane, offset in ((self._cb, 1), (self._cr, 3)):
+                    np.copyto(plane[lines::2, 0::2], field[:, offset::4])
+                    np.copyto(plane[lines::2, 1::2], field[:, offset::4])
+            return
+
+        if self.filter == "nearest":
+            # The top left pixel of every block is on an even line
+            lines = even[:: scale // 2]
+            np.copyto(self._y, lines[:, 0 :: 2 * scale])
+            np.copyto(self._cb, lines[:, 1 :: 2 * scale])
+            np.copyto(self._cr, lines[:, 3 :: 2 * scale])
+            return
+
+        # Add up the scale lines of every block (half of them from each
+        # field), then the columns: scale luma samples, and scale / 2 of
+        # each chroma sample
+        pairs = scale // 2
+        rows = self._rows
+        np.copyto(rows, even[::pairs])
+        for field, first in ((even, 1), (odd, 0)):
+            for line in range(first, pairs):
+                np.add(rows, field[line::pairs], out=rows)
+
+        sums = self._sums
+        for plane, offset, count in (
+            (self._y, 0, scale),
+            (self._cb, 1, pairs),
+            (self._cr, 3, pairs),
+        ):
+            step = 2 if offset == 0 else 4
+            np.copyto(sums, rows[:, offset :: 2 * scale])
+            for column in range(1, count):
+                np.add(sums, rows[:, offset + step * column :: 2 * scale], out=sums)
+            np.multiply(sums, 1 / (scale * count), out=plane)
+
+    # Converts the region of the framebuffer into output
+    @traced("preview")
+    def convert(self, framebuffer, output: np.ndarray = None) -> np.ndarray:
+        if output is None:
+            output = self.allocate()
+        self._load(framebuffer)
+
+        y, cb, cr = self._y, self._cb, self._cr
+        np.subtract(y, self._y_offset, out=y)
+        np.multiply(y, self._y_scale, out=y)
+        # Rounds to nearest once truncated
+        np.add(y, 0.5, out=y)
+        np.subtract(cb, 128, out=cb)
+        np.subtract(cr, 128, out=cr)
+
+        channel, term = self._channel, self._term
+        for index, component in enumerate(self.channels):
+            if component == -1:
+                output[:, :, index] = 255
+                continue
+            if component == 0:
+                np.multiply(cr, self._cr_r, out=term)
+            elif component == 1:
+                np.multiply(cb, self._cb_g, out=term)
+                np.multiply(cr, self._cr_g, out=channel)
+                np.add(term, channel, out=term)
+            else:
+                np.multiply(cb, self._cb_b, out=term)
+            np.add(y, term, out=channel)
+            np.clip(channel, 0, 255, out=channel)
+            np.copyto(output[:, :, index], channel, casting="unsafe")
+
+        return output
@@ -1,16 +1,14 @@
 import numpy as np
-from PIL import Image
 import signal
+import threading
 from time import strftime
 import pygame
-import pyaudio
 
 from easycap import *
-
-try:
-    import cv2
-except:
-    print("OpenCV 2 Not Available. Video can not be recorded.")
+from convert import Converter, LiveImage
+from audio import AUDIO_SAMPLE_RATE, AUDIO_CHANNELS
+from recording import Recorder, Y4MSink
+import tracing
 
 quit_now = False
 screen = None
@@ -18,88 +16,78 @@ record = None
 mute = False
 fps = True
 
-p = pyaudio.PyAudio()
+stream = None
 
-stream = p.open(
-    format=pyaudio.paInt16,
-    channels=2,
-    rate=44100,
-    output=True,
-    # If the audio output is overly staticy, try tuning this value.
-    frames_per_buffer=2048,
-)
 renclock = pygame.time.Clock()
 camclock = pygame.time.Clock()
 
-# Converts a YUYV framebuffer into a YCbCr framebuffer
-def yuyv_to_ycbcr(framebuffer):
-    # Group into 4 byte chunks (-1 means "until the end")
-    yuyv = np.reshape(framebuffer, (-1, 4))
-
-    # Y1 U Y2 V
-    # to
-    # Y1 U V Y2 U V
-    ycbcr = np.column_stack((
-        (yuyv[:, 0], yuyv[:, 1], yuyv[:, 3], yuyv[:, 2], yuyv[:, 1], yuyv[:, 3])
-    ))
-
-    return ycbcr.flatten()
-
-# Deinterlaces the framebuffer
-# This is a simple "weave" deinterlacing algorithm
-def deinterlace(framebuffer, size = (720, 480)):
-    # It's easier to work with when it's reshaped into a 2D array
-    framebuffer = np.reshape(framebuffer, (size[1], size[0] * 3))
-    # Must have a second framebuffer, because we do the deinterlacing in 2 passes
-    output = np.zeros((size[1], size[0] * 3), dtype="uint8")
-
-    half_height = size[1] // 2
-    half_height = 240
-    
-    # First 240 lines go to every other line, starting at line 1
-    output[1::2, :] = framebuffer[:half_height, :]
-    # Last 240 lines go to every other line, starting at line 0
-    output[::2, :] = framebuffer[half_height:, :]
-    
-    return output.flatten()
-
-# Converts the raw framebuffer into a PIL image
-def frame(framebuffer, size = (720, 480)):
-    framebuffer = yuyv_to_ycbcr(framebuffer)
-    
-    framebuffer = deinterlace(framebuffer, size)
-    
-    im = Image.frombuffer(
-        "YCbCr", size, framebuffer, "raw", "YCbCr", 0, 1
-    )
-    im = im.convert("RGB")
-    
-    return im
-
-def display_frame(im: Image.Image, mute: bool, fps: bool, fps_clock: pygame.time.Clock):
-    surface = pygame.image.fromstring(im.tobytes(), im.size, im.mode)
+# Posted by the USB thread when there's a new frame to show. There's only
+# ever one in the queue, however far behind the main loop is.
+FRAME_EVENT = pygame.USEREVENT
+frame_pending = threading.Event()
+
+
+# Text drawn over the video, a character at a time, from glyphs that are
+# only rendered the first time they're needed
+class Overlay:
+    def __init__(self, color=(190, 10, 10)):
+        self.color = color
+        self._fonts = {}
+        self._glyphs = {}
+
+    def draw(self, target: pygame.Surface, text: str, position: tuple, size: int):
+        x, y = position
+        for char in text:
+            glyph = self._glyphs.get((char, size))
+            if glyph is None:
+                if size not in self._fonts:
+                    self._fonts[size] = pygame.font.Font(None, size)
+                glyph = self._fonts[size].render(char, 1, self.color)
+                self._glyphs[(char, size)] = glyph
+            target.blit(glyph, (x, y))
+            x += glyph.get_width()
+
+
+overlay = None
+
+
+# The surface is drawn as is, see frame_surface
+@tracing.traced("display_frame")
+def display_frame(surface: pygame.Surface, mute: bool, fps: bool, fps_clock: pygame.time.Clock):
+    global overlay
+    if overlay is None:
+        overlay = Overlay()
     screen.blit(surface, (0, 0))
 
     if fps:
-        font = pygame.font.Font(None, 36)
-        text = font.render("FPS: %1.1f" % (fps_clock.get_fps()), 1, (190, 10, 10))
-        screen.blit(text, (10, 10))
+        overlay.draw(screen, "FPS: %1.1f" % (fps_clock.get_fps()), (10, 10), 36)
     if mute:
-        font = pygame.font.Font(None, 20)
-        mute = font.render("MUTE", 1, (190, 10, 10))
-        screen.blit(mute, (10, 30))
+        overlay.draw(screen, "MUTE", (10, 30), 20)
     if record is not None:
-        font = pygame.font.Font(None, 36)
-        text = font.render("Recording", 1, (190, 10, 10))
-        screen.blit(text, (590, 450))
+        overlay.draw(screen, "Recording", (590, 450), 36)
 
     pygame.display.flip()
 
 
-def handle_audio(buffer):
+# A surface drawn straight from an (height, width, 3) RGB image, without
+# copying it: whatever is converted into the image shows up on the surface
+def frame_surface(image: np.ndarray) -> pygame.Surface:
+    height, width = image.shape[:2]
+    return pygame.image.frombuffer(image, (width, height), "RGB")
+
+
+# Called on the USB thread with every frame
+def handle_frame(frame):
+    camclock.tick()
+    if not frame_pending.is_set():
+        frame_pending.set()
+        pygame.event.post(pygame.event.Event(FRAME_EVENT))
+
+
+def handle_audio(chunk):
     global mute
     if not mute:
-        stream.write(buffer)
+        stream.write(chunk.data)
 
 
 def signal_handler(signal, frame):
@@ -109,39 +97,69 @@ def signal_handler(signal, frame):
 
 def main():
     signal.signal(signal.SIGINT, signal_handler)
+    # While tracing (see the t key), kill -USR1 dumps what was traced so far
+    tracing.dump_on_signal()
     pygame.init()
-    global screen, quit_now, record, mute, fps
-    screen = pygame.display.set_mode((EASYCAP_VIDEO_WIDTH, EASYCAP_VIDEO_HEIGHT))
+    global screen, quit_now, record, mute, fps, stream
+
+    # Only open the audio device once we actually need it,
+    # so that importing this module has no side effects
+    import pyaudio
+
+    p = pyaudio.PyAudio()
+    stream = p.open(
+        format=pyaudio.paInt16,
+        channels=AUDIO_CHANNELS,
+        rate=AUDIO_SAMPLE_RATE,
+        output=True,
+        # If the audio output is overly staticy, try tuning this value.
+        frames_per_buffer=2048,
+    )
     pygame.display.set_caption("Fushicai EasyCAP utv007")
 
     with EasyCAP() as utv:
-        utv.frame_handler = camclock.tick
+        screen = pygame.display.set_mode(utv.size)
+        # Only reconverts what changed since the last frame
+        live = LiveImage(Converter(utv.size))
+        surface = frame_surface(live.image)
+        utv.frame_handler = handle_frame
         utv.audio_handler = handle_audio
 
+        redraw = True
         while not quit_now:
-            display_frame(frame(utv.framebuffer), mute, fps, camclock)
-
-            #if record is not None and record.isOpened():
-            #    # maybe we should use opencv/highgui instead of pygame
-            #    imcv = cv2.cvtColor(np.asarray(), cv2.COLOR_RGB2BGR)
-            #    # cv2.imshow('frame', imcv)
-            #    record.write(imcv)
-
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
+            # Sleeps until there's a new frame or some input, waking up
+            # now and then to notice ^C
+            events = [pygame.event.wait(250)] + pygame.event.get()
+            for event in events:
+                if event.type == FRAME_EVENT:
+                    frame_pending.clear()
+                    latest = utv.ring.latest()
+                    width, height = live.converter.size
+                    if len(latest.data) != width * height * 2:
+                        # The first frame after a switch of standard
+                        size = (width, len(latest.data) // (2 * width))
+                        screen = pygame.display.set_mode(size)
+                        live = LiveImage(Converter(size))
+                        surface = frame_surface(live.image)
+                    redraw |= live.update(latest)
+                elif event.type == pygame.QUIT:
                     quit_now = True
                     # pass
+                elif event.type == pygame.WINDOWEXPOSED:
+                    redraw = True
                 elif event.type == pygame.KEYDOWN:
+                    # Most keys change what's drawn over the video
+                    redraw = True
                     if event.key == pygame.K_r:
                         if record is None:
-                            # http://stackoverflow.com/questions/10605163/opencv-videowriter-under-osx-producing-no-output
-                            fourcc = cv2.VideoWriter.fourcc("m", "p", "4", "v")
-                            # fourcc = cv2.cv.CV_FOURCC("m", "p", "4", "v")
-                            filename = strftime("Recording %Y-%m-%d %H.%M.%S.mov")
-                            record = cv2.VideoWriter(filename, fourcc, 20.0, (720, 480))
+                            filename = strftime("Recording %Y-%m-%d %H.%M.%S")
+                            sink = Y4MSink(filename + ".y4m", standard=utv.standard)
+                            record = Recorder(utv, sink, filename + ".wav")
+                            record.start()
                         else:
                             print("finishing up the recording")
-                            record.release()
+                            record.stop()
+                            print(record.stats())
                             record = None
                     elif event.key == pygame.K_SPACE:
                         screen.fill(
@@ -149,15 +167,38 @@ def main():
                         )  # flash the screen because its a snapshot
                         pygame.display.flip()
                         filename = strftime("Snapshot %Y-%m-%d %H.%M.%S.jpg")
-                        #im.save(filename)
+                        pygame.image.save(surface, filename)
                         print("Saving snapshot as %s" % filename)
                     elif event.key == pygame.K_m:
                         mute = not mute
                     elif event.key == pygame.K_f:
                         fps = not fps
+                    elif event.key == pygame.K_t:
+                        if tracing.tracer is None:
+                            tracing.start()
+                            print("Tracing")
+                        else:
+                            filename = strftime("Trace %Y-%m-%d %H.%M.%S.json")
+                            tracing.stop().dump(filename)
+                            print("Saving trace as %s" % filename)
+                    elif event.key == pygame.K_s:
+                        # Cycle through the standards
+                        standards = list(STANDARDS)
+                        index = standards.index(utv.standard)
+                        # The window follows once frames of the new size come in
+                        utv.set_standard(standards[(index + 1) % len(standards)])
+                        print("Switched to %s" % utv.standard)
+                    elif event.key == pygame.K_i:
+                        index = INPUTS.index(utv.input)
+                        utv.set_input(INPUTS[(index + 1) % len(INPUTS)])
+                        print("Switched to %s" % utv.input)
+
+            if redraw:
+                display_frame(surface, mute, fps, camclock)
+                redraw = False
         print("exited with")
         if record is not None:
-            record.release()
+            record.stop()
 
 
 if __name__ == "__main__":
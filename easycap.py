@@ -20,11 +20,26 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import time
+
+# Before anything heavy is imported: for python -m easycap, this is about
+# as early as the process runs any code of ours (see cli.py)
+_STARTED = time.perf_counter()
+
 import usb1 as usb
+import functools
 import threading
+from typing import NamedTuple
+
+import numpy as np
 
 #from protocol import *
 import protocol
+import tracing
+from framering import Frame, FrameRing
+from stats import CaptureStats
+from tuning import AdaptiveQueue
+from audio import AUDIO_FRAME_SIZE, AudioChunk, AudioDelivery
 
 
 EASYCAP_VID = 0x1B71
@@ -36,59 +51,462 @@ EASYCAP_VIDEO_WIDTH = 720
 EASYCAP_VIDEO_HEIGHT = 480
 EASYCAP_FRAME_SIZE = EASYCAP_VIDEO_WIDTH * EASYCAP_VIDEO_HEIGHT * 2  # 2 bytes per pixel
 
+# Every isochronous packet is split into 3 sub-packets, each of which has
+# a 4 byte header, 960 bytes of image data and 60 bytes of padding
+EASYCAP_SUB_PACKETS = 3
+EASYCAP_SUB_PACKET_SIZE = 1024
+EASYCAP_SUB_PACKET_HEADER = 4
+EASYCAP_SUB_PACKET_DATA = 960
+EASYCAP_PACKET_SIZE = EASYCAP_SUB_PACKETS * EASYCAP_SUB_PACKET_SIZE
+# 360 packets * 960 bytes = 240 lines * 720 pixels * 2 bytes
+EASYCAP_PACKETS_PER_FIELD = 360
+
+# Audio bulk transfers have a 4 byte header and 12 bytes of padding
+EASYCAP_AUDIO_HEADER = 4
+EASYCAP_AUDIO_PADDING = 12
+
+
+# The frame geometry and rate of a video standard.
+# The EASYCAP_VIDEO_* constants above are NTSC's.
+class Standard(NamedTuple):
+    width: int
+    height: int
+    # Frames per second, as a fraction
+    frame_rate: tuple
+    # Width of a pixel relative to its height, as a fraction (that of
+    # 4:3 pictures digitised as 704 of the 720 columns, per BT.601)
+    pixel_aspect: tuple
+
+    @property
+    def size(self) -> tuple:
+        return (self.width, self.height)
+
+    @property
+    def frame_size(self) -> int:
+        return self.width * self.height * 2
+
+    # 432 for 576 lines, 360 for 480
+    @property
+    def packets_per_field(self) -> int:
+        return self.frame_size // 2 // EASYCAP_SUB_PACKET_DATA
+
+
+STANDARDS = {
+    "NTSC": Standard(720, 480, (30000, 1001), (10, 11)),
+    "PAL": Standard(720, 576, (25, 1), (12, 11)),
+    "SECAM": Standard(720, 576, (25, 1), (12, 11)),
+}
+INPUTS = ("Composite", "S-Video")
+
+
+# Lookup tables for the demuxer, for a given number of packets per field
+class _Layout(NamedTuple):
+    packets_per_field: int
+    # Maps the last 2 bytes of a sub-packet header to the framebuffer row
+    # (960 byte packet) it belongs to, or -1 if the packet counter is corrupt
+    header_rows: np.ndarray
+    # The header (minus the frame counter) expected for each framebuffer row
+    row_headers: np.ndarray
+    field_last_row: int
+    last_row: int
+
+
+@functools.lru_cache()
+def _layout(packets_per_field: int) -> _Layout:
+    header_rows = np.full(0x10000, -1, dtype=np.intp)
+    for interlace in range(2):
+        # Bits 12-14 aren't part of either field, so they can be anything
+        for ignored in range(8):
+            header_rows[
+                (interlace << 15) + (ignored << 12) + np.arange(packets_per_field)
+            ] = interlace * packets_per_field + np.arange(packets_per_field)
+    row_headers = np.array(
+        [
+            0x88000000 | ((row // packets_per_field) << 15)
+            | (row % packets_per_field)
+            for row in range(2 * packets_per_field)
+        ],
+        dtype=np.uint32,
+    )
+    return _Layout(
+        packets_per_field,
+        header_rows,
+        row_headers,
+        packets_per_field - 1,
+        2 * packets_per_field - 1,
+    )
+
+
+_DATA_END = EASYCAP_SUB_PACKET_HEADER + EASYCAP_SUB_PACKET_DATA
+
+
+# A connected EasyCAP, as found by find_devices
+class DeviceInfo(NamedTuple):
+    bus: int
+    # Port numbers from the root hub down, e.g. (1, 4) for 1-1.4
+    port: tuple
+    address: int
+    # None if the device can't be opened to read it
+    serial: str
+    device: usb.USBDevice
+
+
+# Lists every EasyCAP on the given context. Reading serial numbers means
+# opening every device, which can be skipped.
+def find_devices(context: usb.USBContext, serials: bool = True) -> list:
+    devices = []
+    for device in context.getDeviceList(skip_on_error=True):
+        if (
+            device.getVendorID() != EASYCAP_VID
+            or device.getProductID() != EASYCAP_PID
+        ):
+            continue
+        serial = None
+        if serials:
+            try:
+                serial = device.getSerialNumber()
+            except usb.USBError:
+                pass
+        devices.append(
+            DeviceInfo(
+                device.getBusNumber(),
+                tuple(device.getPortNumberList()),
+                device.getDeviceAddress(),
+                serial,
+                device,
+            )
+        )
+    return devices
+
 
 class EasyCAP:
-    def __init__(self):
+    # transfers is the number of ISO transfers kept in flight, each made of
+    # iso_packets packets in a buffer of buffer_size bytes (by default, just
+    # enough for full packets). With adaptive set, the number of transfers
+    # is tuned at runtime (see tuning.AdaptiveQueue). iso_settings() gives
+    # the settings in use, which can be saved with tuning.save_settings and
+    # passed back in as keyword arguments.
+    #
+    # audio_transfers bulk transfers are kept in flight for audio, which is
+    # delivered audio_period frames at a time (see audio.py).
+    #
+    # The first EasyCAP found is used, unless bus, port (see DeviceInfo)
+    # or serial are given. With a context given, the device is looked for
+    # in it, and the context is left to its owner (see manager.py).
+    #
+    # standard and input can also be changed while capturing, see
+    # set_standard and set_input.
+    def __init__(
+        self,
+        frame_buffers: int = 3,
+        standard: str = "NTSC",
+        input: str = "Composite",
+        transfers: int = 20,
+        iso_packets: int = 8,
+        buffer_size: int = None,
+        timeout: int = 1000,
+        adaptive: bool = False,
+        audio_transfers: int = 4,
+        audio_period: int = 1024,
+        bus: int = None,
+        port: tuple = None,
+        serial: str = None,
+        context: usb.USBContext = None,
+    ):
         # This will select the device to use immidately,
         # but we don't want to claim it until the user uses the with
         # statement (__enter__) to guarantee that the device is released
         # properly
 
-        self.usb_context = usb.USBContext()
+        self.owns_context = context is None
+        self.usb_context = usb.USBContext() if context is None else context
 
         self.device = None
 
-        for device in self.usb_context.getDeviceList():
+        for info in find_devices(self.usb_context, serials=serial is not None):
             if (
-                device.getVendorID() == EASYCAP_VID
-                and device.getProductID() == EASYCAP_PID
+                (bus is None or info.bus == bus)
+                and (port is None or info.port == tuple(port))
+                and (serial is None or info.serial == serial)
             ):
-                print("Found EasyCap")
-                self.device = device
+                self.device = info.device
                 break
 
         if not self.device:
             raise Exception("No EasyCap found")
 
+        if input not in INPUTS:
+            raise ValueError("Unknown input: %s" % input)
+        self.input = input
+
+        self._init_capture(frame_buffers, audio_period, standard)
+        self._init_iso(transfers, iso_packets, buffer_size, timeout, adaptive)
+        self.audio_transfers = audio_transfers
+
+    # Sets up everything that doesn't involve the USB device itself
+    def _init_capture(
+        self, frame_buffers: int, audio_period: int = 1024, standard: str = "NTSC"
+    ):
         self.iso = []
-        self.framebuffer = bytearray(EASYCAP_FRAME_SIZE)
+        self.audio_iso = []
+        self.frame_buffers = frame_buffers
+        # Set while the device is open (see protocol.RegisterWriter)
+        self.registers = None
 
         self.ready = False
 
-        # This function is called when a new frame is ready
+        # This function is called with a Frame when a new frame is ready.
+        # It runs on the USB thread, so it should return quickly.
         self.frame_handler = None
-        # This function is called when a new audio sample is ready
+        # This function is called with a Frame and the field number (0 or 1)
+        # every time a field is complete, i.e. at twice the frame rate.
+        # For field 0, the frame is still being captured: only its first
+        # field can be relied on.
+        self.field_handler = None
+        # This function is called with an AudioChunk for every period of
+        # audio, on a thread of its own, so it may block (e.g. for playback)
         self.audio_handler = None
+        # Consumers of every frame and audio chunk (asyncio streams,
+        # conversion pools), see attach_frame_consumer
+        self._frame_consumers = ()
+        self._audio_consumers = ()
+        self._consumers_lock = threading.Lock()
 
         # Audio capture can be disabled to improve video performance
         self.audio_enabled = True
 
         self.frame_counter = 0
+        # When the transfer being parsed completed
+        self._transfer_time = 0
+
+        # Health counters, see stats()
+        self.counters = CaptureStats()
+        self.audio_delivery = AudioDelivery(
+            self._deliver_audio, self.counters, audio_period
+        )
+        # A geometry switch for the USB thread to pick up, see set_standard
+        self._switch = None
+        self._switch_lock = threading.Lock()
+        self.ring = None
+        self._set_standard(standard)
+
+        # Set this to a replay.TransferRecorder to dump the raw USB stream
+        self.recorder = None
+
+        # Set by a CaptureManager, whose thread then handles this
+        # capture's events instead of a thread of its own
+        self.managed = False
+
+    # A snapshot of the health counters (see stats.py).
+    # Safe to call from any thread.
+    def stats(self) -> dict:
+        return self.counters.snapshot()
+
+    # Async iterator over completed frames, for use from an asyncio loop.
+    # See aio.frames() for the backpressure policies (by default
+    # aio.DROP_OLDEST).
+    def frames(self, maxsize: int = 1, policy: str = None, copy: bool = False):
+        import aio
+
+        return aio.frames(self, maxsize, policy or aio.DROP_OLDEST, copy)
+
+    # Async iterator over chunks of audio samples
+    def audio(self, maxsize: int = 16, policy: str = None):
+        import aio
+
+        return aio.audio(self, maxsize, policy or aio.DROP_OLDEST)
+
+    # Attaches an object whose put() method gets called, on the USB thread,
+    # with every completed Frame. It must return quickly. Its close() method
+    # is called when the capture ends.
+    def attach_frame_consumer(self, consumer):
+        with self._consumers_lock:
+            # The tuple is replaced rather than modified,
+            # so the USB thread can go through it without locking
+            self._frame_consumers += (consumer,)
+
+    def detach_frame_consumer(self, consumer):
+        with self._consumers_lock:
+            self._frame_consumers = tuple(
+                c for c in self._frame_consumers if c is not consumer
+            )
+        consumer.close()
+
+    # Same as attach_frame_consumer, but put() gets every chunk of audio
+    def attach_audio_consumer(self, consumer):
+        with self._consumers_lock:
+            self._audio_consumers += (consumer,)
+
+    def detach_audio_consumer(self, consumer):
+        with self._consumers_lock:
+            self._audio_consumers = tuple(
+                c for c in self._audio_consumers if c is not consumer
+            )
+        consumer.close()
+
+    def _close_consumers(self):
+        for consumer in self._frame_consumers + self._audio_consumers:
+            consumer.close()
+
+    def _init_iso(
+        self,
+        transfers: int,
+        iso_packets: int,
+        buffer_size: int,
+        timeout: int,
+        adaptive: bool,
+    ):
+        if buffer_size is None:
+            buffer_size = iso_packets * EASYCAP_PACKET_SIZE
+        if transfers < 1 or iso_packets < 1:
+            raise ValueError("Need at least 1 transfer of at least 1 packet")
+        # libusb splits the buffer evenly between the packets (and refuses
+        # to, on the USB thread, if it can't). Every transfer, including the
+        # ones the tuner adds later on, is made with these settings.
+        if buffer_size % iso_packets:
+            raise ValueError(
+                "%d bytes can't be split evenly into %d packets"
+                % (buffer_size, iso_packets)
+            )
+        if buffer_size // iso_packets < EASYCAP_PACKET_SIZE:
+            raise ValueError(
+                "%d bytes can't hold %d packets of %d bytes"
+                % (buffer_size, iso_packets, EASYCAP_PACKET_SIZE)
+            )
+
+        self.transfers = transfers
+        self.iso_packets = iso_packets
+        self.buffer_size = buffer_size
+        self.timeout = timeout
+        self.tuner = AdaptiveQueue(transfers, iso_packets) if adaptive else None
+
+    # The transfer queue settings in use, as keyword arguments for EasyCAP
+    def iso_settings(self) -> dict:
+        return {
+            "transfers": self.tuner.target if self.tuner else self.transfers,
+            "iso_packets": self.iso_packets,
+            "buffer_size": self.buffer_size,
+            "timeout": self.timeout,
+        }
+
+    # The latest completed frame (read-only)
+    @property
+    def framebuffer(self) -> memoryview:
+        return self.ring.latest().data
+
+    # (width, height) of the frames of the current standard
+    @property
+    def size(self) -> tuple:
+        return self.geometry.size
+
+    # Grayscale for consumers that need nothing else: the luma of a frame
+    # (by default the latest), deinterlaced into a (height, width) uint8
+    # array (preallocated, if output is given). See convert.luma for the
+    # modes; "field" gives a half height image of the given field.
+    def luma(
+        self, frame: Frame = None, mode: str = "weave", field: int = 1, output=None
+    ) -> np.ndarray:
+        from convert import luma
+
+        frame = frame or self.ring.latest()
+        width = self.geometry.width
+        height = len(frame.data) // (2 * width)
+        return luma(frame.data, (width, height), mode, field, output)
+
+    # Switches to another video standard. On a running capture, only the
+    # registers that differ are reprogrammed, and the USB thread moves on
+    # to the new geometry at its next transfer, dropping the frame it was
+    # in the middle of. The ISO transfers carry on regardless.
+    # Frames of a different size come from new framebuffers: ones already
+    # handed out are left alone.
+    #
+    # standard, geometry and size change straight away, so frames of the
+    # old size may still arrive for a little while after this returns:
+    # check the size of a frame before using it.
+    #
+    # This waits for the registers to be written, so it mustn't be called
+    # from a handler.
+    def set_standard(self, standard: str):
+        if standard not in STANDARDS:
+            raise ValueError("Unknown encoding: %s" % standard)
+        if self.registers:
+            protocol.set_standard(self.registers, standard)
+        self._set_standard(standard)
+
+    def _set_standard(self, standard: str):
+        switch = self._prepare_switch(standard)
+        self.standard = standard
+        self.geometry = STANDARDS[standard]
+        if self.ready:
+            with self._switch_lock:
+                self._switch = switch
+        else:
+            self._apply_switch(switch)
+
+    # Switches between "Composite" and "S-Video", also while capturing
+    def set_input(self, input: str):
+        if input not in INPUTS:
+            raise ValueError("Unknown input: %s" % input)
+        if self.registers:
+            protocol.set_input(self.registers, input)
+        self.input = input
+
+    # Works out everything the USB thread needs for a standard, so that
+    # switching to it is only a matter of swapping the ring and the layout
+    def _prepare_switch(self, standard: str) -> tuple:
+        if standard not in STANDARDS:
+            raise ValueError("Unknown encoding: %s" % standard)
+        geometry = STANDARDS[standard]
+        if self.ring and geometry.frame_size == len(self.ring.back):
+            ring = self.ring
+        else:
+            # The USB thread fills one of these while consumers read the others
+            ring = FrameRing(
+                geometry.frame_size, EASYCAP_SUB_PACKET_DATA, self.frame_buffers
+            )
+        return ring, _layout(geometry.packets_per_field)
+
+    def _apply_switch(self, switch: tuple):
+        ring, self._layout = switch
+        if self.ring and ring is not self.ring:
+            ring.continue_from(self.ring)
+        self.ring = ring
+        # Rows of the back buffer received so far
+        self._received = np.zeros(len(self._layout.row_headers), dtype=bool)
+        # The row the next sub-packet should fill, and the frame counter of
+        # the last completed frame (None until the stream has started)
+        self._next_row = None
+        self._last_frame_counter = None
+
+    # Called by the USB thread before parsing a transfer
+    def _take_switch(self):
+        with self._switch_lock:
+            switch, self._switch = self._switch, None
+        if switch:
+            self._apply_switch(switch)
 
     def __enter__(self):
         self.device_handle = self.device.open()
 
         self.device_handle.claimInterface(EASYCAP_INTERFACE)
 
-        protocol.begin_capture(self.device_handle)
-        protocol.set_standard(self.device_handle, "NTSC")
-        protocol.set_input(self.device_handle, "Composite")
+        # A fresh shadow cache: the device may have been reset since
+        self.registers = protocol.RegisterWriter(self.device_handle, self.usb_context)
+        protocol.begin_capture(self.registers)
+        protocol.set_standard(self.registers, self.standard)
+        protocol.set_input(self.registers, self.input)
 
         if self.audio_enabled:
+            self.audio_delivery.start()
             self.begin_audio_capture()
         # Enable the Alternative Mode (Used for streaming?)
         self.device_handle.setInterfaceAltSetting(EASYCAP_INTERFACE, 1)
 
+        if self.managed:
+            self.ready = True
+            self.submit_transfers()
+            return self
+
         threading.Thread(target=self.kickoff).start()
         #if self.audio_enabled:
         #    self.begin_audio_capture()
@@ -108,37 +526,241 @@ class EasyCAP:
 
         if self.audio_enabled:
             self.end_audio_capture()
+            self.audio_delivery.stop()
+        self._close_consumers()
+
+        self.registers = None
+        self._take_switch()
 
         self.device_handle.releaseInterface(EASYCAP_INTERFACE)
         self.device_handle.close()
-        self.usb_context.exit()
+        if self.owns_context:
+            self.usb_context.exit()
 
     # This function (which runs in it's own thread) will
-    # kick off the 20 iso transfers, then handle all pending USB events
+    # kick off the iso transfers, then handle all pending USB events
     # until we're told to stop
     def kickoff(self):
-        for i in range(20):
-            self.transfer_iso()
+        self.submit_transfers()
         while self.ready:
             self.handle_usb_events()
 
+    def submit_transfers(self):
+        for i in range(self.transfers):
+            self.transfer_iso()
+
     def transfer_iso(self):
-        iso = self.device_handle.getTransfer(iso_packets=8)
+        iso = self.device_handle.getTransfer(iso_packets=self.iso_packets)
         iso.setIsochronous(
-            0x81, buffer_or_len=0x6000, callback=self.iso_ready, timeout=1000
+            0x81,
+            buffer_or_len=self.buffer_size,
+            callback=self.iso_ready,
+            timeout=self.timeout,
+        )
+        # getBuffer returns the very memory libusb writes into, so a view
+        # of it, one row per packet, stays valid for the transfer's lifetime
+        iso.setUserData(
+            np.frombuffer(iso.getBuffer(), dtype=np.uint8).reshape(
+                self.iso_packets, -1
+            )
         )
         iso.submit()
         self.iso.append(iso)
+        self.counters.iso_transfers = len(self.iso)
 
     def handle_usb_events(self):
         self.usb_context.handleEvents()
 
-    def build_images(self, buffer_list, setup_list):
+    # The timestamp (monotonic nanoseconds) is when the transfer completed,
+    # and defaults to now
+    @tracing.traced("build_images")
+    def build_images(self, buffer_list, setup_list, timestamp: int = None):
+        self._transfer_time = time.monotonic_ns() if timestamp is None else timestamp
+        if self._switch:
+            self._take_switch()
+        lengths = [int(setup["actual_length"]) for setup in setup_list]
+
+        # The vectorized demuxer only understands packets that are either
+        # empty or completely full, which is all the device ever sends.
+        # Anything else goes through the (slow) reference implementation.
+        for length in lengths:
+            if length != 0 and length != EASYCAP_PACKET_SIZE:
+                self._build_images_python(buffer_list, setup_list)
+                return
+
+        # Glue every non-empty packet together, and view the result as a
+        # 2D array with one row per sub-packet
+        packets = [
+            buffer_list[i][:EASYCAP_PACKET_SIZE]
+            for i in range(len(buffer_list))
+            if lengths[i]
+        ]
+        if not packets:
+            return
+        sub_packets = np.frombuffer(b"".join(packets), dtype=np.uint8).reshape(
+            -1, EASYCAP_SUB_PACKET_SIZE
+        )
+        self.demux(sub_packets)
+
+    # Same as build_images, but reads the packets straight out of a
+    # (packets x packet length) view of the transfer buffer, so that the
+    # only copy made is the one into the framebuffer
+    @tracing.traced("build_images")
+    def build_transfer(
+        self, packets: np.ndarray, lengths: list, timestamp: int = None
+    ):
+        self._transfer_time = time.monotonic_ns() if timestamp is None else timestamp
+        if self._switch:
+            self._take_switch()
+        # Runs of consecutive full packets are contiguous in memory,
+        # so they can be handed to the demuxer without copying
+        start = None
+        for i, length in enumerate(lengths):
+            if length == EASYCAP_PACKET_SIZE:
+                if start is None:
+                    start = i
+                continue
+
+            if start is not None:
+                self._demux_packets(packets[start:i])
+                start = None
+            if length == 0:
+                self.counters.empty_packets += 1
+            else:
+                self.counters.short_packets += 1
+                self._build_images_python(
+                    [memoryview(packets[i])], [{"actual_length": length}]
+                )
+
+        if start is not None:
+            self._demux_packets(packets[start:])
+
+    def _demux_packets(self, packets: np.ndarray):
+        self.demux(
+            packets[:, :EASYCAP_PACKET_SIZE].reshape(-1, EASYCAP_SUB_PACKET_SIZE)
+        )
+
+    def demux(self, sub_packets: np.ndarray):
+        # Decode all the headers at once. Viewed as a big endian 32 bit
+        # word, the header is 0x88, the frame counter, then the interlace
+        # bit and packet counter (see _build_images_python for details)
+        headers = sub_packets.view(">u4")[:, 0]
+        layout = self._layout
+
+        # Fast path: every sub-packet is valid, and they fill consecutive
+        # rows of the framebuffer, so they can be copied over in one slice
+        row = int(layout.header_rows[headers[0] & 0xFFFF])
+        count = len(headers)
+        row_headers = layout.row_headers
+        if (
+            row >= 0
+            and row + count <= len(row_headers)
+            and np.array_equal(headers & 0xFF00FFFF, row_headers[row : row + count])
+        ):
+            self.frame_counter = int(headers[-1] >> 16) & 0xFF
+            self._copy_rows(sub_packets, 0, row, count)
+            return
+
+        rows = layout.header_rows[headers & 0xFFFF]
+        marked = (headers >> 24) == 0x88
+        valid = np.flatnonzero(marked & (rows >= 0))
+        if valid.size != count:
+            marked = int(np.count_nonzero(marked))
+            self.counters.invalid_markers += count - marked
+            self.counters.invalid_counters += marked - valid.size
+        if not valid.size:
+            return
+        rows = rows[valid]
+
+        # Most of the time the sub-packets fill consecutive rows of the
+        # framebuffer, so they can be copied over as a few large slices.
+        # A slice ends wherever that isn't the case, and after the last row
+        # of a frame, so that the frame handler sees exactly what the
+        # original loop showed it (_copy_rows splits at the end of a field).
+        ends = np.flatnonzero(
+            (np.diff(valid) != 1)
+            | (np.diff(rows) != 1)
+            | (rows[:-1] == layout.last_row)
+        )
+        start = 0
+        for end in ends.tolist() + [len(valid) - 1]:
+            self.frame_counter = int(headers[valid[end]] >> 16) & 0xFF
+            self._copy_rows(
+                sub_packets, int(valid[start]), int(rows[start]), end - start + 1
+            )
+            start = end + 1
+
+    # Copies count sub-packets, starting at index first, into consecutive
+    # rows of the back buffer, then signals any field or frame completed
+    def _copy_rows(self, sub_packets: np.ndarray, first: int, row: int, count: int):
+        field_last_row = self._layout.field_last_row
+        last_row = self._layout.last_row
+        if row <= field_last_row < row + count - 1:
+            # The first field ends in the middle, so the field handler
+            # must see it before the second field starts arriving
+            split = field_last_row - row + 1
+            self._copy_rows(sub_packets, first, row, split)
+            first += split
+            row += split
+            count -= split
+
+        self.ring.write_rows(
+            row,
+            sub_packets[first : first + count, EASYCAP_SUB_PACKET_HEADER:_DATA_END],
+        )
+        self._received[row : row + count] = True
+
+        last = row + count - 1
+        if self._next_row is not None and row != self._next_row:
+            self.counters.packet_counter_gaps += 1
+        self._next_row = 0 if last == last_row else last + 1
+        if last == field_last_row:
+            if self.field_handler:
+                self.field_handler(self.ring.pending(self._transfer_time), 0)
+        elif last == last_row:
+            self._frame_complete()
+
+    def _frame_complete(self):
+        counters = self.counters
+        counters.frames_completed += 1
+        received = int(np.count_nonzero(self._received))
+        missing = None
+        if received != len(self._received):
+            counters.frames_incomplete += 1
+            counters.packets_missing += len(self._received) - received
+            missing = ~self._received
+        self._received[:] = False
+        if (
+            self._last_frame_counter is not None
+            and (self.frame_counter - self._last_frame_counter) & 0xFF != 1
+        ):
+            counters.frame_counter_gaps += 1
+        self._last_frame_counter = self.frame_counter
+
+        # Hand the back buffer over to the consumers, and start on the next one
+        frame = self.ring.publish(self._transfer_time, missing)
+        if self.frame_handler:
+            start = time.perf_counter_ns()
+            self.frame_handler(frame)
+            end = time.perf_counter_ns()
+            counters.frame_handler.add(end - start)
+            if tracing.tracer:
+                tracing.tracer.add("frame_handler", start, end)
+        for consumer in self._frame_consumers:
+            consumer.put(frame)
+        if self.field_handler:
+            self.field_handler(frame, 1)
+
+    # The original, packet-by-packet implementation of build_images.
+    # It is kept around for oddly sized packets, and as a reference for
+    # the vectorized demuxer above.
+    def _build_images_python(self, buffer_list, setup_list):
         # Trim buffers down to their "actual length"
         packets = [
             buffer_list[i][: int(setup_list[i]["actual_length"])]
             for i in range(len(buffer_list))
         ]
+        packets_per_field = self._layout.packets_per_field
         for packet in packets:
             if len(packet) == 0:
                 continue
@@ -150,6 +772,7 @@ class EasyCAP:
                 # First byte is always 0x88
                 if sub_packet[0] != 0x88:
                     # Skip empty/invalid packets
+                    self.counters.invalid_markers += 1
                     continue
 
                 # This could be used to detect dropped frames
@@ -159,57 +782,167 @@ class EasyCAP:
                 # The first bit is the interlace bit, and the 2nd-4th bits are ignored
                 # The 5th-8th bits form the first 4 bits of the packet counter
                 # Which are then OR'd with the 3rd byte of the packet
-                # (Only the last bit of the sub_packet[2] is used, as it only goes to 360...)
+                # (Only the last bit of the sub_packet[2] is used, as it only goes to 432...)
                 packet_counter = ((sub_packet[2] & 0x0F) << 8) | sub_packet[3]
                 interlace = (sub_packet[2] & 0xF0) >> 7  # opposite of original
+                if packet_counter >= packets_per_field:
+                    # Corrupt counter, it doesn't fit in the framebuffer
+                    self.counters.invalid_counters += 1
+                    continue
 
-                # Add 360 to the packet number if the interlace bit is set,
-                # So that it turns it into a continuous range 0-720
-                # Then multiply by 960 (the amount of data in each packet)
-                offset = (packet_counter + (interlace * 360)) * 960
+                # Add 360 (432 for PAL) to the packet number if the interlace
+                # bit is set, so that it turns it into a continuous range 0-720
+                # of 960 byte rows (the amount of data in each packet)
+                row = packet_counter + interlace * packets_per_field
 
                 # Remove the first 4 bytes and the last 60 bytes (which are padding)
                 frame_data = sub_packet[4:-60]
+                if len(frame_data) != EASYCAP_SUB_PACKET_DATA:
+                    # Oddly sized packet, it would resize the framebuffer
+                    continue
                 # Copy the data into the framebuffer
-                self.framebuffer[offset : offset + 960] = frame_data
+                self.ring.write_rows(
+                    row, np.frombuffer(frame_data, dtype=np.uint8).reshape(1, -1)
+                )
+
+                self._received[row] = True
+                if self._next_row is not None and row != self._next_row:
+                    self.counters.packet_counter_gaps += 1
+                self._next_row = 0 if row == self._layout.last_row else row + 1
 
                 # 360 packets * 2 times (interlaced) * 960 bytes per packet = 691200 = 720 * 480 * 2
 
                 # We've drawn a whole frame
-                if interlace == 1 and packet_counter == 359 and self.frame_handler:
-                    self.frame_handler()
+                if interlace == 1 and packet_counter == packets_per_field - 1:
+                    self._frame_complete()
+                elif packet_counter == packets_per_field - 1 and self.field_handler:
+                    self.field_handler(self.ring.pending(self._transfer_time), 0)
 
     def iso_ready(self, transfer: usb.USBTransfer):
-        buffer_list = transfer.getISOBufferList()
+        start = time.perf_counter_ns()
+        timestamp = time.monotonic_ns()
+        counters = self.counters
+        counters.transfer_status[transfer.getStatus()] += 1
+
+        # Unlike getISOBufferList, this doesn't copy every packet
         setup_list = transfer.getISOSetupList()
-        self.build_images(buffer_list, setup_list)
+        lengths = [setup["actual_length"] for setup in setup_list]
+        for setup in setup_list:
+            if setup["status"]:
+                counters.packet_status[setup["status"]] += 1
+        if self.recorder:
+            self.recorder.write_iso(transfer.getUserData(), lengths, timestamp)
+        self.build_transfer(transfer.getUserData(), lengths, timestamp)
 
         # Because this is a callback, we need to make sure that
         # we don't try and submit if we're not in a ready state
         if self.ready:
+            # The tuner may retire this transfer rather than resubmit it
+            if not (self.tuner and self._resize_queue(transfer, start)):
+                try:
+                    # Submits the transfer, it will get called again
+                    transfer.submit()
+                except usb.USBError as e:
+                    counters.resubmit_failures += 1
+                    print("Unable to submit transfer", e)
+        end = time.perf_counter_ns()
+        counters.iso_callback.add(end - start)
+        if tracing.tracer:
+            tracing.tracer.add("iso_ready", start, end)
+
+    # Grows or shrinks the transfer queue to what the tuner asks for.
+    # Returns whether the given transfer should be dropped from it.
+    def _resize_queue(self, transfer: usb.USBTransfer, now: int) -> bool:
+        target = self.tuner.update(self.counters, now)
+        if target == len(self.iso):
+            return False
+
+        self.counters.iso_resizes += 1
+        if target < len(self.iso):
+            # Shrink by letting this transfer go
+            self.iso.remove(transfer)
+            self.counters.iso_transfers = len(self.iso)
+            return True
+        for _ in range(target - len(self.iso)):
             try:
-                # Submits the transfer, it will get called again
-                transfer.submit()
+                self.transfer_iso()
             except usb.USBError as e:
+                self.counters.resubmit_failures += 1
                 print("Unable to submit transfer", e)
+                break
+        return False
 
     def _audio_callback(self, transfer: usb.USBTransfer):
-        if self.audio_handler:
-            audio_buffer = transfer.getBuffer()[4:-12]
-            self.audio_handler(bytes(audio_buffer))
+        start = time.perf_counter_ns()
+        timestamp = time.monotonic_ns()
+        status = transfer.getStatus()
+        self.counters.audio_status[status] += 1
+
+        # Timed out, cancelled or failed transfers hold stale samples
+        if status == usb.TRANSFER_COMPLETED:
+            length = transfer.getActualLength()
+            samples = length - EASYCAP_AUDIO_HEADER - EASYCAP_AUDIO_PADDING
+            # Whole sample frames only, so the channels stay in step
+            samples -= samples % AUDIO_FRAME_SIZE
+            if self.recorder:
+                self.recorder.write_audio(transfer.getBuffer()[:length], timestamp)
+            if samples > 0:
+                self._audio_received(transfer.getUserData()[:samples], timestamp)
 
         if self.ready:
             try:
                 transfer.submit()
             except usb.USBError as e:
+                self.counters.resubmit_failures += 1
                 print("Unable to submit transfer", e)
+        end = time.perf_counter_ns()
+        self.counters.audio_callback.add(end - start)
+        if tracing.tracer:
+            tracing.tracer.add("audio_callback", start, end)
+
+    def _audio_received(self, samples: memoryview, timestamp: int):
+        # Copied into the ring, as the transfer is about to be reused
+        self.audio_delivery.write(samples, timestamp)
+
+    # Called on the audio delivery thread with every period
+    @tracing.traced("deliver_audio")
+    def _deliver_audio(self, chunk: AudioChunk):
+        if self.audio_handler:
+            self.audio_handler(chunk)
+        for consumer in self._audio_consumers:
+            consumer.put(chunk)
 
     def begin_audio_capture(self):
-        protocol.enable_audio(self.device_handle)
-
-        audio_transfer = self.device_handle.getTransfer()
-        audio_transfer.setBulk(0x83, buffer_or_len=256, callback=self._audio_callback, timeout=1000)
-        audio_transfer.submit()
+        protocol.enable_audio(self.registers)
+
+        # With several transfers queued up, there is always one ready
+        # for the device while the others are being handled
+        for i in range(self.audio_transfers):
+            audio_transfer = self.device_handle.getTransfer()
+            audio_transfer.setBulk(0x83, buffer_or_len=256, callback=self._audio_callback, timeout=1000)
+            # The samples sit between a 4 byte header and 12 bytes of padding
+            audio_transfer.setUserData(
+                memoryview(audio_transfer.getBuffer())[
+                    EASYCAP_AUDIO_HEADER:-EASYCAP_AUDIO_PADDING
+                ]
+            )
+            audio_transfer.submit()
+            self.audio_iso.append(audio_transfer)
 
     def end_audio_capture(self):
-        protocol.disable_audio(self.device_handle)
\ No newline at end of file
+        protocol.disable_audio(self.registers)
+        for audio_transfer in self.audio_iso:
+            try:
+                audio_transfer.cancel()
+            except:
+                pass
+
+
+if __name__ == "__main__":
+    # python -m easycap, see cli.py. The command line imports easycap
+    # itself, rather than using this copy of it run as __main__.
+    import sys
+
+    import cli
+
+    sys.exit(cli.main(started=_STARTED))
@@ -0,0 +1,131 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+from typing import NamedTuple
+
+import numpy as np
+
+
+# A completed frame, as handed out to consumers
+class Frame(NamedTuple):
+    # Read-only view of the raw YUYV framebuffer
+    data: memoryview
+    # Increases by one for every completed frame, starting at 1
+    sequence: int
+    # When the transfer that completed it did (monotonic nanoseconds)
+    timestamp: int = 0
+    # Read-only mask of the rows (packets) that differ from the previous
+    # frame's, or None if there is nothing to compare with. Valid for as
+    # long as the data.
+    dirty: np.ndarray = None
+
+    # Whether the frame is byte for byte the same as the previous one
+    def unchanged(self) -> bool:
+        return self.dirty is not None and not self.dirty.any()
+
+
+# A fixed pool of preallocated framebuffers.
+#
+# The USB thread fills the "back" buffer, and when a frame is complete it
+# publishes it by moving on to the next buffer in the ring. Nothing is ever
+# copied, and nothing is ever locked: a published frame is left alone until
+# the writer comes back around to it, which is (count - 1) frames later.
+#
+# Rows written with write_rows are compared with the previous frame's on
+# the way in, which gives every frame its dirty mask.
+class FrameRing:
+    def __init__(self, frame_size: int, row_size: int, count: int = 3):
+        if count < 3:
+            # With only 2 buffers, the writer would start overwriting
+            # the latest frame as soon as it was published
+            raise ValueError("Need at least 3 framebuffers, got %d" % count)
+
+        self.count = count
+        self.buffers = [bytearray(frame_size) for _ in range(count)]
+        # Numpy views, one row per packet, used by the demuxer
+        self.rows = [
+            np.frombuffer(buffer, dtype=np.uint8).reshape(-1, row_size)
+            for buffer in self.buffers
+        ]
+        self._readonly = [memoryview(buffer).toreadonly() for buffer in self.buffers]
+        self.dirty = [np.ones(len(rows), dtype=bool) for rows in self.rows]
+        self._readonly_dirty = [mask.view() for mask in self.dirty]
+        for mask in self._readonly_dirty:
+            mask.flags.writeable = False
+
+        self.index = 0
+        self.back = self.buffers[0]
+        self.back_rows = self.rows[0]
+        self.back_dirty = self.dirty[0]
+        # The rows of the last frame published, to compare the next with
+        self._previous_rows = None
+
+        # Before the first frame arrives, the latest frame is a blank one
+        self.sequence = 0
+        self._latest = Frame(self._readonly[count - 1], 0)
+
+    # Copies rows into the back buffer, starting at the given one,
+    # and marks those that differ from the previous frame as dirty
+    def write_rows(self, row: int, data: np.ndarray):
+        end = row + len(data)
+        if self._previous_rows is None:
+            self.back_dirty[row:end] = True
+        else:
+            changed = data != self._previous_rows[row:end]
+            np.any(changed, axis=1, out=self.back_dirty[row:end])
+        self.back_rows[row:end] = data
+
+    # Called by the USB thread once the back buffer holds a whole frame.
+    # missing is a mask of the rows that weren't written this time, if any:
+    # they still hold an older frame's data, so they count as dirty.
+    def publish(self, timestamp: int = 0, missing: np.ndarray = None) -> Frame:
+        if missing is not None:
+            self.back_dirty[missing] = True
+        frame = Frame(
+            self._readonly[self.index],
+            self.sequence + 1,
+            timestamp,
+            self._readonly_dirty[self.index],
+        )
+
+        self._previous_rows = self.back_rows
+        self.index = (self.index + 1) % self.count
+        self.back = self.buffers[self.index]
+        self.back_rows = self.rows[self.index]
+        self.back_dirty = self.dirty[self.index]
+
+        # Assigning a single attribute is atomic, so readers either see
+        # the previous frame or this one, never something in between
+        self._latest = frame
+        self.sequence = frame.sequence
+        return frame
+
+    # The frame currently being captured, as it will be numbered once it is
+    # published. Only the parts already received can be relied on.
+    def pending(self, timestamp: int = 0) -> Frame:
+        return Frame(self._readonly[self.index], self.sequence + 1, timestamp)
+
+    def latest(self) -> Frame:
+        return self._latest
+
+    # Takes over from another ring (e.g. one of another frame size): frames
+    # carry on counting from its sequence, and its latest frame stays the
+    # latest until this ring publishes one
+    def continue_from(self, ring: "FrameRing"):
+        self.sequence = ring.sequence
+        self._latest = ring.latest()
+
+    # Whether the writer has not yet come back around to this frame's buffer.
+    # Check this after reading a frame to know the data was not torn.
+    def is_intact(self, frame: Frame) -> bool:
+        return self.sequence - frame.sequence < self.count - 1
@@ -0,0 +1,132 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Runs several captures from a single USB context and a single thread.
+#
+#   with CaptureManager() as manager:
+#       for info in manager.devices():
+#           cap = manager.open(serial=info.serial)
+#           cap.frame_handler = ...
+#       manager.start()
+#       ...
+#
+# Every capture keeps its own framebuffers, handlers and stats. Replays
+# (replay.ReplayEasyCAP) can be added alongside, or instead of, devices,
+# and are then driven from the same thread.
+
+import threading
+import time
+
+import usb1 as usb
+
+from easycap import EasyCAP, find_devices
+from replay import ReplayEasyCAP
+
+
+class CaptureManager:
+    # poll_interval is the longest (in seconds) the thread goes without
+    # checking whether it should stop
+    def __init__(self, poll_interval: float = 0.1):
+        self.poll_interval = poll_interval
+        self.context = None
+        self.captures = []
+        self.thread = None
+        self.running = False
+
+    def __enter__(self):
+        self.context = usb.USBContext()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+        self.context.exit()
+        self.context = None
+
+    # Every EasyCAP on the shared context, see easycap.find_devices
+    def devices(self, serials: bool = True) -> list:
+        return find_devices(self.context, serials)
+
+    # Opens a device on the shared context, taking the same
+    # keyword arguments as EasyCAP
+    def open(self, **kwargs) -> EasyCAP:
+        return self.add(EasyCAP(context=self.context, **kwargs))
+
+    # Adds a capture that was created elsewhere: a replay, or an EasyCAP
+    # opened on this manager's context
+    def add(self, cap: EasyCAP) -> EasyCAP:
+        if self.running:
+            raise ValueError("Can't add captures while running")
+        if not isinstance(cap, ReplayEasyCAP) and (
+            cap.usb_context is not self.context
+        ):
+            raise ValueError("The device must be opened on the manager's context")
+        cap.managed = True
+        self.captures.append(cap)
+        return cap
+
+    # Starts every capture, and the thread that drives them
+    def start(self):
+        started = []
+        try:
+            for cap in self.captures:
+                cap.__enter__()
+                started.append(cap)
+        except:
+            for cap in reversed(started):
+                cap.__exit__(None, None, None)
+            raise
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    # Stops every capture. The thread keeps handling events until the
+    # devices have been stopped, so that their transfers can be cancelled,
+    # but must be gone before replays close their files.
+    def stop(self):
+        if not self.running:
+            return
+        for cap in self.captures:
+            if not isinstance(cap, ReplayEasyCAP):
+                cap.__exit__(None, None, None)
+        self.running = False
+        self.thread.join()
+        self.thread = None
+        for cap in self.captures:
+            if isinstance(cap, ReplayEasyCAP):
+                cap.__exit__(None, None, None)
+
+    # Waits for every replay to finish
+    def wait(self, timeout: float = None):
+        for cap in self.captures:
+            if isinstance(cap, ReplayEasyCAP):
+                cap.wait(timeout)
+
+    def run(self):
+        replays = [cap for cap in self.captures if isinstance(cap, ReplayEasyCAP)]
+        devices = len(replays) < len(self.captures)
+
+        while self.running:
+            # Wait for USB events until the next replayed record is due
+            timeout = self.poll_interval
+            for replay in replays:
+                if replay.finished:
+                    continue
+                delay = replay.poll()
+                if delay is not None:
+                    timeout = min(timeout, delay / 1e9)
+
+            if devices:
+                self.context.handleEventsTimeout(timeout)
+            elif timeout:
+                time.sleep(timeout)
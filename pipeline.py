@@ -0,0 +1,260 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Colour conversion, deinterlacing and encoding in a pool of worker
+# processes, so that the capture process is left with nothing to do but
+# service the USB device.
+#
+#   with EasyCAP() as cap, ConversionPool(cap, workers=4) as pool:
+#       for result in pool.results():
+#           ...
+#
+# Completed frames are copied once, on the USB thread, into a ring of
+# slots in shared memory. Workers convert straight from their slot into a
+# matching output slot, so frames never go through a pipe. Results come
+# back in frame order.
+
+import collections
+import io
+import multiprocessing
+import os
+import threading
+import weakref
+from multiprocessing import shared_memory
+from typing import NamedTuple
+
+import numpy as np
+
+from convert import Converter
+
+
+# A converted frame. The image is a view of shared memory, only valid
+# until the next result is requested. encoded holds the encoded image,
+# if the pool was asked to encode.
+class Result(NamedTuple):
+    sequence: int
+    image: np.ndarray
+    encoded: bytes
+
+
+# Everything a worker process needs, set up once by _init_worker
+_worker = None
+
+
+def _init_worker(frames_name, images_name, frame_size, options):
+    global _worker
+    converter = Converter(
+        options["size"],
+        options["format"],
+        options["full_range"],
+        options["deinterlace"],
+    )
+    shape = converter.allocate().shape
+    # Spawned workers share the parent's resource tracker,
+    # so attaching doesn't make them owners of the memory
+    frames = shared_memory.SharedMemory(frames_name)
+    images = shared_memory.SharedMemory(images_name)
+    _worker = {
+        "converter": converter,
+        "frames": frames,
+        "images": images,
+        "frame_size": frame_size,
+        "image_size": int(np.prod(shape)),
+        "shape": shape,
+        "options": options,
+    }
+
+
+def _convert(slot: int):
+    converter = _worker["converter"]
+    frame_size = _worker["frame_size"]
+    image_size = _worker["image_size"]
+    framebuffer = _worker["frames"].buf[slot * frame_size : (slot + 1) * frame_size]
+    image = np.ndarray(
+        _worker["shape"],
+        dtype=np.uint8,
+        buffer=_worker["images"].buf,
+        offset=slot * image_size,
+    )
+    converter.convert(framebuffer, image)
+    framebuffer.release()
+
+    encode = _worker["options"]["encode"]
+    if not encode:
+        return None
+    from PIL import Image
+
+    encoded = io.BytesIO()
+    Image.fromarray(image[..., :3] if image.shape[2] == 4 else image).save(
+        encoded, encode, quality=_worker["options"]["quality"]
+    )
+    return encoded.getvalue()
+
+
+def _ready(_):
+    return True
+
+
+class ConversionPool:
+    def __init__(
+        self,
+        cap,
+        workers: int = None,
+        slots: int = None,
+        format: str = "RGB",
+        full_range: bool = False,
+        deinterlace: str = "weave",
+        encode: str = None,
+        quality: int = 85,
+    ):
+        # encode is a PIL format name, e.g. "JPEG" or "PNG"
+        if format in ("BGR", "BGRA") and encode:
+            raise ValueError("Can only encode RGB or RGBA images")
+
+        self.cap = cap
+        self.workers = workers or os.cpu_count() or 1
+        # Enough slots to keep every worker busy with one frame
+        # while another one is waiting for it
+        self.slots = slots or 2 * self.workers
+        # Frames of another size, after a switch of standard, are dropped
+        self.options = {
+            "size": cap.size,
+            "format": format,
+            "full_range": full_range,
+            "deinterlace": deinterlace,
+            "encode": encode,
+            "quality": quality,
+        }
+
+        # Validates the options, and gives the output shape
+        self.shape = Converter(
+            cap.size, format, full_range, deinterlace
+        ).allocate().shape
+        self.frame_size = len(cap.ring.buffers[0])
+        self.image_size = int(np.prod(self.shape))
+
+        # Frames that arrived while every slot was taken
+        self.dropped = 0
+
+        self.pool = None
+        self._frames = None
+        self._images = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.terminate()
+
+    def start(self):
+        self._frames = shared_memory.SharedMemory(
+            create=True, size=self.frame_size * self.slots
+        )
+        self._images = shared_memory.SharedMemory(
+            create=True, size=self.image_size * self.slots
+        )
+        self._frame_slots = np.ndarray(
+            (self.slots, self.frame_size), dtype=np.uint8, buffer=self._frames.buf
+        )
+        self._image_slots = np.ndarray(
+            (self.slots,) + self.shape, dtype=np.uint8, buffer=self._images.buf
+        )
+        # Results are views of the slots, so the memory is only unmapped
+        # once the slots, and every view of them, are gone
+        weakref.finalize(self._frame_slots, self._frames.close)
+        weakref.finalize(self._image_slots, self._images.close)
+
+        # Forking a process that has libusb threads running isn't safe
+        self.pool = multiprocessing.get_context("spawn").Pool(
+            self.workers,
+            _init_worker,
+            (self._frames.name, self._images.name, self.frame_size, self.options),
+        )
+        # Wait for every worker to start up, so the first frames aren't late
+        self.pool.map(_ready, range(self.workers), chunksize=1)
+
+        self._free = collections.deque(range(self.slots))
+        # (sequence, slot, AsyncResult) of every frame in flight, in order
+        self._pending = collections.deque()
+        self._available = threading.Condition()
+        # Keeps terminate() from taking the pool and the memory away under
+        # a put() in progress
+        self._lock = threading.Lock()
+        self._closed = False
+        # The slot of the last result handed out, freed on the next one
+        self._current = None
+
+        self.cap.attach_frame_consumer(self)
+
+    # Called by the USB thread with every completed frame
+    def put(self, frame):
+        with self._lock:
+            if self.pool is None:
+                return
+            with self._available:
+                if self._closed:
+                    return
+                if not self._free or len(frame.data) != self.frame_size:
+                    self.dropped += 1
+                    return
+                slot = self._free.popleft()
+
+            self._frame_slots[slot] = np.frombuffer(frame.data, dtype=np.uint8)
+            result = self.pool.apply_async(_convert, (slot,))
+
+            with self._available:
+                self._pending.append((frame.sequence, slot, result))
+                self._available.notify()
+
+    # Ends results() once every frame in flight has been returned.
+    # Called by the capture when it ends.
+    def close(self):
+        if self.pool is None:
+            return
+        with self._available:
+            self._closed = True
+            self._available.notify_all()
+
+    # Yields a Result for every converted frame, in frame order, until
+    # the pool (or the capture) is closed
+    def results(self, timeout: float = None):
+        while True:
+            with self._available:
+                if self._current is not None:
+                    self._free.append(self._current)
+                    self._current = None
+                while not self._pending and not self._closed:
+                    if not self._available.wait(timeout):
+                        return
+                if not self._pending:
+                    return
+                sequence, slot, result = self._pending.popleft()
+
+            self._current = slot
+            encoded = result.get()
+            yield Result(sequence, self._image_slots[slot], encoded)
+
+    # Stops the workers and frees the shared memory. Results already
+    # handed out stay readable, the memory goes with the last of them.
+    def terminate(self):
+        if self.pool is None:
+            return
+        self.cap.detach_frame_consumer(self)
+        with self._lock:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            del self._frame_slots, self._image_slots
+            for memory in (self._frames, self._images):
+                memory.unlink()
@@ -14,6 +14,8 @@
 # You should have received a copy of the GNU General Public License
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
+import threading
+
 import usb1 as usb
 
 
@@ -61,7 +63,118 @@ def set_registers(device_handle: usb.USBDeviceHandle, registers: list):
             raise Exception("Unexpected reply %02x" % reply)
 
 
-def set_standard(device_handle: usb.USBDeviceHandle, standard: str):
+# Writes registers in batches of asynchronous control transfers, and
+# remembers what was last written to each one so that writes which would
+# change nothing are skipped.
+#
+# The device handles control transfers in the order they were submitted,
+# so a batch has the same effect as writing its registers one at a time,
+# with one wait for the whole batch rather than a round trip per register.
+#
+# Any device handle will do, as long as it has getTransfer(), and its
+# transfers have setControl(), submit(), getStatus() and call back once
+# they complete (see synthetic.FakeDeviceHandle). context is only used
+# to handle events while waiting, and may be None if the transfers
+# complete as they are submitted.
+class RegisterWriter:
+    def __init__(self, device_handle, context, timeout: int = 1000):
+        self.device_handle = device_handle
+        self.context = context
+        self.timeout = timeout
+        # Register index -> last value written
+        self.shadow = {}
+        # Transfers are reused from one batch to the next
+        self._transfers = []
+        # Transfers of the current batch still to complete, and set once
+        # they all have. They complete on whichever thread handles events.
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._done = threading.Event()
+        self._failed = []
+
+        self.writes = 0
+        self.skipped = 0
+
+    # Forgets every written value, e.g. after the device was reset
+    def invalidate(self):
+        self.shadow.clear()
+
+    # Writes a list of [index, value] registers, in order, and waits for
+    # them to be written
+    def write(self, registers: list):
+        batch = []
+        for index, value in registers:
+            if self.shadow.get(index) == value:
+                self.skipped += 1
+                continue
+            self.shadow[index] = value
+            batch.append((index, value))
+        if not batch:
+            return
+
+        while len(self._transfers) < len(batch):
+            self._transfers.append(self.device_handle.getTransfer())
+        self._failed = []
+        # One more than the transfers in flight until they're all
+        # submitted, so that it can't reach 0 before the last one is
+        self._pending = 1
+        self._done = threading.Event()
+
+        for transfer, (index, value) in zip(self._transfers, batch):
+            transfer.setControl(
+                usb.ENDPOINT_OUT
+                | usb.libusb1.LIBUSB_TYPE_VENDOR
+                | usb.libusb1.LIBUSB_RECIPIENT_DEVICE,
+                USBTV_REQUEST_REG,
+                value,
+                index,
+                b"",
+                callback=self._completed,
+                user_data=index,
+                timeout=self.timeout,
+            )
+            with self._lock:
+                self._pending += 1
+            try:
+                transfer.submit()
+            except:
+                self._failed.append((index, None))
+                self._release()
+                break
+        self._release()
+
+        # This handles events itself, or waits for the capture's USB thread
+        # to if it's already at it. Every transfer times out eventually, so
+        # this can't wait forever.
+        while not self._done.is_set():
+            self.context.handleEventsTimeout(self.timeout / 1000)
+        self.writes += len(batch)
+
+        if self._failed:
+            # What the device holds now is anyone's guess
+            for index, value in batch:
+                self.shadow.pop(index, None)
+            index, status = self._failed[0]
+            if status is None:
+                raise Exception("Couldn't submit a write to register %04x" % index)
+            raise Exception(
+                "Unexpected status %d writing register %04x" % (status, index)
+            )
+
+    def _completed(self, transfer):
+        status = transfer.getStatus()
+        if status != usb.TRANSFER_COMPLETED:
+            self._failed.append((transfer.getUserData(), status))
+        self._release()
+
+    def _release(self):
+        with self._lock:
+            self._pending -= 1
+            if not self._pending:
+                self._done.set()
+
+
+def set_standard(registers: RegisterWriter, standard: str):
     AVPAL = [
         # "AVPAL" tuning sequence from .INF file
         [USBTV_BASE + 0x0003, 0x0004],
@@ -147,23 +260,23 @@ def set_standard(device_handle: usb.USBDeviceHandle, standard: str):
     ]
 
     if standard == "NTSC":
-        set_registers(device_handle, AVNTSC)
+        tuning = AVNTSC
         norm = 0x00B8
     elif standard == "PAL":
-        set_registers(device_handle, AVPAL)
+        tuning = AVPAL
         norm = 0x00EE
     elif standard == "SECAM":
         print("WARNING: SECAM not tested")
-        set_registers(device_handle, AVSECAM)
+        tuning = AVSECAM
         norm = 0x00FF
     else:
         raise ValueError("Unknown encoding: %s" % standard)
 
     # Set the norm (not really sure what this is, and there seem to be more options in the Linux driver)
-    set_registers(device_handle, [[USBTV_BASE + 0x016F, norm]])
+    registers.write(tuning + [[USBTV_BASE + 0x016F, norm]])
 
 
-def set_input(device_handle, input):
+def set_input(registers: RegisterWriter, input: str):
     COMPOSITE = [
         [USBTV_BASE + 0x0105, 0x0060],
         [USBTV_BASE + 0x011F, 0x00F2],
@@ -181,14 +294,14 @@ def set_input(device_handle, input):
     ]
 
     if input == "S-Video":
-        set_registers(device_handle, SVIDEO)
+        registers.write(SVIDEO)
     elif input == "Composite":
-        set_registers(device_handle, COMPOSITE)
+        registers.write(COMPOSITE)
     else:
         raise ValueError("Unknown input: %s" % input)
 
 
-def begin_capture(device_handle):
+def begin_capture(registers: RegisterWriter):
     SETUP = [
         # These seem to enable the device.
         [USBTV_BASE + 0x0008, 0x0001],
@@ -250,12 +363,12 @@ def begin_capture(device_handle):
         [USBTV_BASE + 0x015D, 0x0000],
     ]
 
-    set_registers(device_handle, SETUP)
+    registers.write(SETUP)
 
 
 ## AUDIO
 
-def enable_audio(device_handle: usb.USBDeviceHandle):
+def enable_audio(registers: RegisterWriter):
     SETUP = [
         # These seem to enable the device.
         [USBTV_BASE + 0x0008, 0x0001],
@@ -279,9 +392,9 @@ def enable_audio(device_handle: usb.USBDeviceHandle):
         [USBTV_BASE + 0x0284, 0x00AA],
     ]
 
-    set_registers(device_handle, SETUP)
+    registers.write(SETUP)
 
-def disable_audio(device_handle: usb.USBDeviceHandle):
+def disable_audio(registers: RegisterWriter):
     SETUP = [
         # The original windows driver sometimes sends also:
         #   [ USBTV_BASE + 0x00a2, 0x0013 ],
@@ -293,4 +406,4 @@ def disable_audio(device_handle: usb.USBDeviceHandle):
 		[ USBTV_BASE + 0x0282, 0x0010 ],
     ]
 
-    set_registers(device_handle, SETUP)
+    registers.write(SETUP)
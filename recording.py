@@ -0,0 +1,298 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Recording of captured video (and audio) to disk, or to an encoder.
+#
+#   with Recorder(cap, Y4MSink("out.y4m"), wav_path="out.wav"):
+#       ...
+#
+# Completed frames are copied into one of a fixed number of buffers on the
+# USB thread, and written out by a worker thread. If the sink falls behind
+# and every buffer is in use, frames are dropped (and counted): recording
+# never holds up the capture.
+#
+# Sinks get frames in the device's field order, and write them out
+# deinterlaced by weaving, as progressive frames of interlaced video:
+#
+#   RawSink:     YUYV 4:2:2, frame after frame, with an index file of
+#                u64 offset, u64 sequence, u64 timestamp (little endian)
+#                for every frame
+#   Y4MSink:     YUV4MPEG2, planar 4:2:2
+#   EncoderSink: YUV4MPEG2, piped into an encoder, e.g.
+#                ["ffmpeg", "-i", "-", "-c:v", "libx264", "out.mp4"]
+#   PNGSink:     an RGB PNG image per frame (slow, so best with a limited
+#                number of frames, see Recorder)
+
+import collections
+import queue
+import struct
+import subprocess
+import threading
+import wave
+
+import numpy as np
+
+from audio import AUDIO_CHANNELS, AUDIO_SAMPLE_RATE, AudioChunk
+from convert import Converter, deinterlace
+from easycap import EASYCAP_VIDEO_WIDTH, EASYCAP_VIDEO_HEIGHT, STANDARDS
+
+# Large writes, so that frames go out in few system calls
+WRITE_BUFFER_SIZE = 1 << 22
+
+_INDEX_ENTRY = struct.Struct("<QQQ")
+
+
+class Sink:
+    def __init__(self, size=None):
+        self.size = size or (EASYCAP_VIDEO_WIDTH, EASYCAP_VIDEO_HEIGHT)
+        width, height = self.size
+        # The woven frame, one row of YUYV per line
+        self._frame = np.empty((height, width * 2), dtype=np.uint8)
+
+    # Called by the worker with every frame, as a flat array in field order
+    def write_frame(self, framebuffer: np.ndarray, sequence: int, timestamp: int):
+        raise NotImplementedError
+
+    def _weave(self, framebuffer: np.ndarray) -> np.ndarray:
+        deinterlace(framebuffer, self.size, output=self._frame)
+        return self._frame
+
+    def close(self):
+        pass
+
+
+class RawSink(Sink):
+    def __init__(self, path: str, index_path: str = None, size=None):
+        super().__init__(size)
+        self.file = open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+        self.index = open(index_path or path + ".idx", "wb")
+        self.offset = 0
+
+    def write_frame(self, framebuffer, sequence, timestamp):
+        frame = self._weave(framebuffer)
+        self.index.write(_INDEX_ENTRY.pack(self.offset, sequence, timestamp))
+        self.file.write(frame)
+        self.offset += frame.nbytes
+
+    def close(self):
+        self.file.close()
+        self.index.close()
+
+
+# The size, frame rate and pixel aspect ratio all come from the standard
+class Y4MSink(Sink):
+    def __init__(self, path: str = None, standard: str = "NTSC", file=None):
+        geometry = STANDARDS[standard]
+        super().__init__(geometry.size)
+        self.file = file or open(path, "wb", buffering=WRITE_BUFFER_SIZE)
+
+        width, height = self.size
+        # The first field the device sends holds the odd lines,
+        # i.e. the bottom field
+        self.file.write(
+            b"YUV4MPEG2 W%d H%d F%d:%d Ib A%d:%d C422\n"
+            % ((width, height) + geometry.frame_rate + geometry.pixel_aspect)
+        )
+        self._planes = np.empty(width * height * 2, dtype=np.uint8)
+        self._y = self._planes[: width * height].reshape(height, width)
+        self._cb = self._planes[width * height : width * height * 3 // 2].reshape(
+            height, width // 2
+        )
+        self._cr = self._planes[width * height * 3 // 2 :].reshape(height, width // 2)
+
+    def write_frame(self, framebuffer, sequence, timestamp):
+        frame = self._weave(framebuffer)
+        # Y U Y V to planar
+        np.copyto(self._y, frame[:, 0::2])
+        np.copyto(self._cb, frame[:, 1::4])
+        np.copyto(self._cr, frame[:, 3::4])
+        self.file.write(b"FRAME\n")
+        self.file.write(self._planes)
+
+    def close(self):
+        self.file.close()
+
+
+class EncoderSink(Y4MSink):
+    # command reads YUV4MPEG2 from its standard input
+    def __init__(self, command: list, standard: str = "NTSC"):
+        self.process = subprocess.Popen(
+            command, stdin=subprocess.PIPE, bufsize=WRITE_BUFFER_SIZE
+        )
+        super().__init__(standard=standard, file=self.process.stdin)
+
+    def close(self):
+        super().close()
+        self.process.wait()
+
+
+class PNGSink(Sink):
+    # path holds a %d for the number of the frame, counting from 0
+    def __init__(self, path: str = "frame-%06d.png", size=None):
+        super().__init__(size)
+        self.path = path
+        self.converter = Converter(self.size)
+        self._image = self.converter.allocate()
+        self.count = 0
+
+    def write_frame(self, framebuffer, sequence, timestamp):
+        from PIL import Image
+
+        self.converter.convert(framebuffer, self._image)
+        # Compressing harder takes several times as long, for a few percent
+        Image.fromarray(self._image).save(self.path % self.count, compress_level=1)
+        self.count += 1
+
+
+# Marks the end of an input in the worker's queue
+_CLOSED = object()
+
+
+# Takes frames or audio chunks as a capture consumer
+class _Input:
+    def __init__(self, put, queue: queue.SimpleQueue):
+        self.put = put
+        self.queue = queue
+        self.closed = False
+
+    # Called when the capture ends, or the recorder is stopped,
+    # so possibly twice
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.queue.put(_CLOSED)
+
+
+class Recorder:
+    # buffers is how many frames can be waiting to be written,
+    # audio_chunks the same for audio. Frames are expected in the size of
+    # the capture's standard when the recorder is made: after a switch to
+    # another size, they are dropped.
+    #
+    # With a number of frames given, frames after that many have been taken
+    # in are ignored, and finished is set (the recorder still has to be
+    # stopped).
+    def __init__(
+        self,
+        cap,
+        sink: Sink,
+        wav_path: str = None,
+        buffers: int = 8,
+        audio_chunks: int = 256,
+        frames: int = None,
+    ):
+        self.cap = cap
+        self.sink = sink
+        self.wav_path = wav_path
+        self.audio_chunks = audio_chunks
+
+        self.frame_size = len(cap.ring.back)
+        self._free = collections.deque(
+            np.empty(self.frame_size, dtype=np.uint8) for _ in range(buffers)
+        )
+        self._queue = queue.SimpleQueue()
+        # Only ever increased by the audio thread and the worker respectively
+        self._audio_queued = 0
+        self._audio_written = 0
+        self._frames = _Input(self._put_frame, self._queue)
+        self._audio = _Input(self._put_audio, self._queue)
+        self.wav = None
+        self.thread = None
+        self.frames = frames
+        self.finished = threading.Event()
+
+        self.frames_taken = 0
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.audio_dropped = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        if self.wav_path:
+            self.wav = wave.open(self.wav_path, "wb")
+            self.wav.setnchannels(AUDIO_CHANNELS)
+            self.wav.setsampwidth(2)
+            self.wav.setframerate(AUDIO_SAMPLE_RATE)
+            self.cap.attach_audio_consumer(self._audio)
+        self.cap.attach_frame_consumer(self._frames)
+
+        self.thread = threading.Thread(target=self.run)
+        self.thread.start()
+
+    # Stops recording, once everything queued has been written
+    def stop(self):
+        if not self.thread:
+            return
+        self.cap.detach_frame_consumer(self._frames)
+        if self.wav:
+            self.cap.detach_audio_consumer(self._audio)
+        self.thread.join()
+        self.thread = None
+
+        self.sink.close()
+        if self.wav:
+            self.wav.close()
+
+    def stats(self) -> dict:
+        return {
+            "frames_written": self.frames_written,
+            "frames_dropped": self.frames_dropped,
+            "audio_dropped": self.audio_dropped,
+        }
+
+    # Called by the USB thread
+    def _put_frame(self, frame):
+        if self.finished.is_set():
+            return
+        if len(frame.data) != self.frame_size:
+            self.frames_dropped += 1
+            return
+        try:
+            buffer = self._free.popleft()
+        except IndexError:
+            self.frames_dropped += 1
+            return
+        np.copyto(buffer, np.frombuffer(frame.data, dtype=np.uint8))
+        self._queue.put((buffer, frame.sequence, frame.timestamp))
+        self.frames_taken += 1
+        if self.frames_taken == self.frames:
+            self.finished.set()
+
+    # Called by the audio delivery thread
+    def _put_audio(self, chunk: AudioChunk):
+        if self._audio_queued - self._audio_written >= self.audio_chunks:
+            self.audio_dropped += 1
+            return
+        self._audio_queued += 1
+        self._queue.put(chunk)
+
+    def run(self):
+        inputs = 2 if self.wav else 1
+        while inputs:
+            item = self._queue.get()
+            if item is _CLOSED:
+                inputs -= 1
+            elif isinstance(item, AudioChunk):
+                self.wav.writeframesraw(item.data)
+                self._audio_written += 1
+            else:
+                buffer, sequence, timestamp = item
+                self.sink.write_frame(buffer, sequence, timestamp)
+                self.frames_written += 1
+                self._free.append(buffer)
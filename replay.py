@@ -0,0 +1,297 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Recording and replaying of the raw USB stream, so that the capture
+# pipeline can be run without a device.
+#
+# A capture file looks like this (everything is little endian):
+#
+#   File header: "EZCAPRAW", u32 version, u32 reserved
+#   Records:     u8 kind, u8 reserved, u16 packet count, u32 payload size,
+#                u64 timestamp (monotonic nanoseconds),
+#                u32 actual length for every packet (ISO records only),
+#                then the whole transfer buffer
+#   Index:       u64 record offset, u64 timestamp, for every record
+#   Footer:      "EZCAPIDX", u64 index offset, u64 record count
+#
+# The index and footer are written when the recorder is closed. If they
+# are missing (the recording was interrupted), the index is rebuilt by
+# walking the records.
+
+import bisect
+import mmap
+import struct
+import threading
+import time
+
+import numpy as np
+
+from easycap import EasyCAP, EASYCAP_AUDIO_HEADER, EASYCAP_AUDIO_PADDING
+
+CAPTURE_MAGIC = b"EZCAPRAW"
+CAPTURE_VERSION = 1
+INDEX_MAGIC = b"EZCAPIDX"
+
+RECORD_ISO = 1
+RECORD_AUDIO = 2
+
+_FILE_HEADER = struct.Struct("<8sII")
+_RECORD_HEADER = struct.Struct("<BxHIQ")
+_INDEX_ENTRY = struct.Struct("<QQ")
+_FOOTER = struct.Struct("<8sQQ")
+
+
+class TransferRecorder:
+    def __init__(self, path: str):
+        # Writes happen on the USB thread, so buffer generously
+        self.file = open(path, "wb", buffering=1 << 20)
+        self.file.write(_FILE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_VERSION, 0))
+        self.offset = _FILE_HEADER.size
+        self.index = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _write(self, kind: int, lengths: list, payload, timestamp: int = None):
+        if timestamp is None:
+            timestamp = time.monotonic_ns()
+        payload = memoryview(payload).cast("B")
+
+        self.index.append((self.offset, timestamp))
+        header = _RECORD_HEADER.pack(kind, len(lengths), len(payload), timestamp)
+        self.file.write(header)
+        if lengths:
+            self.file.write(struct.pack("<%dI" % len(lengths), *lengths))
+        self.file.write(payload)
+        self.offset += len(header) + 4 * len(lengths) + len(payload)
+
+    # Records an ISO transfer, given the (packets x packet length) view
+    # of its buffer and the actual length of every packet.
+    # The timestamp defaults to now, but can be given for synthetic streams.
+    def write_iso(self, packets: np.ndarray, lengths: list, timestamp: int = None):
+        self._write(RECORD_ISO, lengths, packets, timestamp)
+
+    # Records an audio transfer, given its whole buffer
+    def write_audio(self, buffer, timestamp: int = None):
+        self._write(RECORD_AUDIO, [], buffer, timestamp)
+
+    def close(self):
+        if self.file.closed:
+            return
+        for entry in self.index:
+            self.file.write(_INDEX_ENTRY.pack(*entry))
+        self.file.write(_FOOTER.pack(INDEX_MAGIC, self.offset, len(self.index)))
+        self.file.close()
+
+
+# A single record of a capture file. The payload is a view into the
+# memory-mapped file, so it is only valid while the file is open.
+class Record:
+    def __init__(self, kind: int, timestamp: int, lengths: list, payload: memoryview):
+        self.kind = kind
+        self.timestamp = timestamp
+        self.lengths = lengths
+        self.payload = payload
+
+    # The (packets x packet length) view build_transfer expects
+    def packets(self) -> np.ndarray:
+        return np.frombuffer(self.payload, dtype=np.uint8).reshape(
+            len(self.lengths), -1
+        )
+
+
+# Memory-mapped, random access reader for capture files
+class CaptureFile:
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+        magic, version, _ = _FILE_HEADER.unpack_from(self.map, 0)
+        if magic != CAPTURE_MAGIC:
+            raise ValueError("%s is not a capture file" % path)
+        if version != CAPTURE_VERSION:
+            raise ValueError("Unsupported capture file version %d" % version)
+
+        self.offsets, self.timestamps = self._read_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _read_index(self):
+        if len(self.map) >= _FILE_HEADER.size + _FOOTER.size:
+            magic, index_offset, count = _FOOTER.unpack_from(
+                self.map, len(self.map) - _FOOTER.size
+            )
+            if magic == INDEX_MAGIC:
+                index = np.frombuffer(
+                    self.map, dtype="<u8", count=count * 2, offset=index_offset
+                ).reshape(-1, 2)
+                return index[:, 0].tolist(), index[:, 1].tolist()
+
+        # No index, walk the records (ignoring a truncated last one)
+        end = len(self.map)
+        offsets, timestamps = [], []
+        offset = _FILE_HEADER.size
+        while offset + _RECORD_HEADER.size <= end:
+            _, count, size, timestamp = _RECORD_HEADER.unpack_from(self.map, offset)
+            next_offset = offset + _RECORD_HEADER.size + 4 * count + size
+            if next_offset > end:
+                break
+            offsets.append(offset)
+            timestamps.append(timestamp)
+            offset = next_offset
+        return offsets, timestamps
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i: int) -> Record:
+        offset = self.offsets[i]
+        kind, count, size, timestamp = _RECORD_HEADER.unpack_from(self.map, offset)
+        offset += _RECORD_HEADER.size
+        lengths = list(struct.unpack_from("<%dI" % count, self.map, offset))
+        offset += 4 * count
+        return Record(kind, timestamp, lengths, self.view[offset : offset + size])
+
+    # Index of the first record at or after the given number of
+    # seconds into the capture
+    def seek(self, seconds: float) -> int:
+        if not self.timestamps:
+            return 0
+        target = self.timestamps[0] + int(seconds * 1e9)
+        return bisect.bisect_left(self.timestamps, target)
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+        self.file.close()
+
+
+# Stands in for an EasyCAP, feeding a capture file through the same
+# parsing code as a real device. Frames and audio are stamped with the
+# times they were recorded at.
+#
+# With realtime set, transfers are delivered at the pace they were
+# recorded at, otherwise as fast as possible. Capture files don't say
+# which standard they were recorded in, so that has to be given.
+#
+# Like an EasyCAP, it runs on a thread of its own, unless it is added to
+# a manager.CaptureManager, which then calls poll() from its thread.
+class ReplayEasyCAP(EasyCAP):
+    def __init__(
+        self,
+        path: str,
+        realtime: bool = True,
+        start: float = 0.0,
+        frame_buffers: int = 3,
+        audio_period: int = 1024,
+        standard: str = "NTSC",
+    ):
+        self.path = path
+        self.realtime = realtime
+        self.start = start
+        self.capture = None
+        self.thread = None
+        self._done = threading.Event()
+
+        self._init_capture(frame_buffers, audio_period, standard)
+
+    def __enter__(self):
+        self.capture = CaptureFile(self.path)
+        self._next = self.capture.seek(self.start)
+        self._start_time = time.monotonic_ns()
+        if self._next < len(self.capture):
+            self._first_timestamp = self.capture.timestamps[self._next]
+        self._done.clear()
+
+        self.ready = True
+        if self.audio_enabled:
+            self.audio_delivery.start()
+        if not self.managed:
+            self.thread = threading.Thread(target=self.kickoff)
+            self.thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.ready = False
+        self.audio_delivery.stop()
+        self._close_consumers()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+        self._done.set()
+        self.capture.close()
+
+    # Whether the whole capture file has been replayed
+    @property
+    def finished(self) -> bool:
+        return self._done.is_set()
+
+    # Waits for the whole capture file to be replayed
+    def wait(self, timeout: float = None):
+        self._done.wait(timeout)
+
+    def kickoff(self):
+        while self.ready:
+            delay = self.poll()
+            if delay is None:
+                break
+            if delay:
+                time.sleep(delay / 1e9)
+
+    # Delivers up to limit records that are due. Returns how long (in ns)
+    # until the next one is, or None once the whole file has been replayed.
+    def poll(self, limit: int = 64) -> int:
+        for _ in range(limit):
+            if not self.ready or self._next >= len(self.capture):
+                self._finish()
+                return None
+
+            if self.realtime:
+                due = self.capture.timestamps[self._next] - self._first_timestamp
+                delay = due - (time.monotonic_ns() - self._start_time)
+                if delay > 0:
+                    return delay
+
+            record = self.capture[self._next]
+            self._next += 1
+            if record.kind == RECORD_ISO:
+                self.build_transfer(record.packets(), record.lengths, record.timestamp)
+            elif record.kind == RECORD_AUDIO and self.audio_enabled:
+                samples = record.payload[EASYCAP_AUDIO_HEADER:-EASYCAP_AUDIO_PADDING]
+                if not self.realtime:
+                    # There's no device to keep up with, so rather than
+                    # overrun, wait for the audio consumers to catch up
+                    delivery = self.audio_delivery
+                    while (
+                        self.ready
+                        and delivery.running
+                        and delivery.ring.free() < len(samples)
+                    ):
+                        time.sleep(delivery.period_ns / 4e9)
+                self._audio_received(samples, record.timestamp)
+        return 0
+
+    def _finish(self):
+        if not self._done.is_set():
+            # The end of the file is the end of the stream
+            self.audio_delivery.stop()
+            self._close_consumers()
+            self._done.set()
@@ -0,0 +1,273 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Serves a capture to any number of clients on the local network:
+#
+#   MJPEG over HTTP:   http://host:8080/stream.mjpg, or /snapshot.jpg
+#   raw YUYV over TCP: every frame as a RAW_HEADER followed by the
+#                      framebuffer, in the device's field order
+#
+#   with EasyCAP() as cap:
+#       async with FrameServer(cap) as server:
+#           await server.serve_forever()
+#
+# Every frame is encoded at most once per format, and only while a client
+# of that format is connected. All the clients are then handed the very
+# same bytes. Each client has a single slot for the next frame to send it,
+# so a slow client skips frames (counted in its dropped) without holding
+# up the others, or the capture.
+
+import asyncio
+import concurrent.futures
+import io
+import struct
+
+from convert import Converter
+
+# magic, width, height, sequence, timestamp (monotonic ns), data length
+RAW_HEADER = struct.Struct("<4sHHQQI")
+RAW_MAGIC = b"YUYV"
+
+_BOUNDARY = b"frame"
+
+
+# A connected client, and the frame waiting to be sent to it
+class _Client:
+    def __init__(self, kind: str, writer: asyncio.StreamWriter):
+        self.kind = kind
+        self.writer = writer
+        self.address = writer.get_extra_info("peername")
+        self._next = None
+        self._ready = asyncio.Event()
+        self._stopped = False
+
+        self.sent = 0
+        self.dropped = 0
+
+    # Hands over a frame, as a tuple of byte strings, replacing one that
+    # hasn't been sent yet
+    def offer(self, chunks: tuple):
+        if self._next is not None:
+            self.dropped += 1
+        self._next = chunks
+        self._ready.set()
+
+    # Makes run() return, and drops the connection. Closing it would wait
+    # for whatever is buffered to be sent, which a stalled client never
+    # takes.
+    def stop(self):
+        self._stopped = True
+        self._ready.set()
+        self.writer.transport.abort()
+
+    # Sends frames as they are offered, until the client goes away, it's
+    # stopped, or (with a limit) enough have been sent
+    async def run(self, limit: int = None):
+        try:
+            while limit is None or self.sent < limit:
+                await self._ready.wait()
+                self._ready.clear()
+                if self._stopped:
+                    break
+                chunks, self._next = self._next, None
+                self.writer.writelines(chunks)
+                await self.writer.drain()
+                self.sent += 1
+        except ConnectionError:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "kind": self.kind,
+            "address": self.address,
+            "sent": self.sent,
+            "dropped": self.dropped,
+        }
+
+
+class FrameServer:
+    # Either port can be None to leave that server out, or 0 for any free
+    # port (see http_port and raw_port once started). quality and
+    # deinterlace are for the JPEG images.
+    def __init__(
+        self,
+        cap,
+        host: str = "127.0.0.1",
+        http_port: int = 8080,
+        raw_port: int = 8081,
+        quality: int = 85,
+        deinterlace: str = "weave",
+    ):
+        self.cap = cap
+        self.host = host
+        self.http_port = http_port
+        self.raw_port = raw_port
+        self.quality = quality
+        self.deinterlace = deinterlace
+
+        self.clients = []
+        self._servers = []
+        self._tasks = set()
+        self._pump = None
+        # Encoding runs on a thread of its own, into a single image
+        self._encoder = None
+        self._converter = None
+        self._image = None
+
+        self.frames_encoded = 0
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.stop()
+
+    async def start(self):
+        self._encoder = concurrent.futures.ThreadPoolExecutor(1)
+        if self.http_port is not None:
+            server = await asyncio.start_server(
+                self._serve_http, self.host, self.http_port
+            )
+            self.http_port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        if self.raw_port is not None:
+            server = await asyncio.start_server(
+                self._serve_raw, self.host, self.raw_port
+            )
+            self.raw_port = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        self._pump = asyncio.create_task(self._run())
+
+    async def serve_forever(self):
+        await asyncio.gather(*(server.serve_forever() for server in self._servers))
+
+    async def stop(self):
+        for server in self._servers:
+            server.close()
+        self._pump.cancel()
+        # The handlers return by themselves once their clients are stopped:
+        # cancelling them would have asyncio log every one
+        for client in list(self.clients):
+            client.stop()
+        await asyncio.gather(self._pump, *self._tasks, return_exceptions=True)
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+        self._encoder.shutdown()
+
+    def stats(self) -> dict:
+        return {
+            "frames_encoded": self.frames_encoded,
+            "clients": [client.stats() for client in self.clients],
+        }
+
+    # Takes every frame from the capture, and hands it to the clients
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        async for frame in self.cap.frames(maxsize=1):
+            kinds = {client.kind for client in self.clients}
+
+            if "raw" in kinds:
+                width = self.cap.size[0]
+                data = bytes(frame.data)
+                # Overwritten while it was copied, and so is the rest
+                if not self.cap.ring.is_intact(frame):
+                    continue
+                header = RAW_HEADER.pack(
+                    RAW_MAGIC,
+                    width,
+                    len(data) // (2 * width),
+                    frame.sequence,
+                    frame.timestamp,
+                    len(data),
+                )
+                self._offer("raw", (header, data))
+
+            if "mjpeg" in kinds or "snapshot" in kinds:
+                jpeg = await loop.run_in_executor(self._encoder, self._encode, frame)
+                # The ring may have come back around to it in the meantime
+                if not jpeg or not self.cap.ring.is_intact(frame):
+                    continue
+                part = (
+                    b"--%s\r\nContent-Type: image/jpeg\r\nContent-Length: %d\r\n\r\n"
+                    % (_BOUNDARY, len(jpeg))
+                )
+                self._offer("mjpeg", (part, jpeg, b"\r\n"))
+                self._offer("snapshot", (jpeg,))
+
+    def _offer(self, kind: str, chunks: tuple):
+        for client in self.clients:
+            if client.kind == kind:
+                client.offer(chunks)
+
+    def _encode(self, frame) -> bytes:
+        from PIL import Image
+
+        size = self.cap.size
+        if self._converter is None or self._converter.size != size:
+            self._converter = Converter(size, deinterlace=self.deinterlace)
+            self._image = self._converter.allocate()
+        if len(frame.data) != size[0] * size[1] * 2:
+            # From before a switch of standard
+            return b""
+
+        self._converter.convert(frame.data, self._image)
+        encoded = io.BytesIO()
+        Image.fromarray(self._image).save(encoded, "JPEG", quality=self.quality)
+        self.frames_encoded += 1
+        return encoded.getvalue()
+
+    # Keeps a client registered for as long as it is being served
+    async def _serve(self, kind: str, writer: asyncio.StreamWriter, limit=None):
+        client = _Client(kind, writer)
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        self.clients.append(client)
+        try:
+            await client.run(limit)
+        finally:
+            self.clients.remove(client)
+            self._tasks.discard(task)
+            writer.close()
+
+    async def _serve_raw(self, reader, writer):
+        await self._serve("raw", writer)
+
+    async def _serve_http(self, reader, writer):
+        try:
+            request = await reader.readline()
+            # The headers don't matter
+            while (await reader.readline()).strip():
+                pass
+        except ConnectionError:
+            writer.close()
+            return
+        parts = request.split()
+        path = parts[1].decode("latin-1") if len(parts) > 1 else ""
+
+        if path in ("/", "/stream.mjpg"):
+            writer.write(
+                b"HTTP/1.0 200 OK\r\n"
+                b"Cache-Control: no-cache\r\n"
+                b"Content-Type: multipart/x-mixed-replace; boundary=%s\r\n\r\n"
+                % _BOUNDARY
+            )
+            await self._serve("mjpeg", writer)
+        elif path == "/snapshot.jpg":
+            # A single part, sent as the whole body
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: image/jpeg\r\n\r\n")
+            await self._serve("snapshot", writer, limit=1)
+        else:
+            writer.write(b"HTTP/1.0 404 Not Found\r\n\r\n")
+            writer.close()
@@ -0,0 +1,381 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Frames and audio for other processes, through named shared memory.
+#
+# In the capture process:
+#
+#   with EasyCAP() as cap, SharedPublisher(cap, "easycap"):
+#       ...
+#
+# In any number of other processes:
+#
+#   with SharedReader("easycap") as reader:
+#       for frame in reader.frames():
+#           ...  # frame.data is a view of the shared memory
+#           if not reader.is_intact(frame):
+#               ...  # it was overwritten while in use, throw away the result
+#
+# The memory holds a header, a ring of frame slots and a ring of audio:
+#
+#   header   16 x u64: magic, version, slots, slot size, audio capacity,
+#            latest frame sequence, audio lock, audio bytes written,
+#            sample index and timestamp at the end of the audio
+#   slots    8 x u64 each: lock, sequence, timestamp, width, height,
+#            length
+#   frames   slots x slot size bytes of YUYV, in the device's field order
+#   audio    audio capacity bytes of 16 bit stereo
+#
+# Readers never lock anything, so they can't hold up the capture. Instead,
+# every slot has a seqlock: the publisher makes its lock odd while it
+# writes, and even again once it's done. A reader that sees the same even
+# value before and after reading knows that what it read was whole.
+
+import threading
+import time
+import weakref
+from multiprocessing import resource_tracker, shared_memory
+from typing import NamedTuple
+
+import numpy as np
+
+from audio import AUDIO_FRAME_SIZE, AUDIO_SAMPLE_RATE, AudioChunk
+from easycap import STANDARDS
+
+MAGIC = int.from_bytes(b"EZCAPSHM", "little")
+VERSION = 1
+
+# Names published from this process
+_published = set()
+
+_HEADER_WORDS = 16
+_SLOT_WORDS = 8
+
+# Header words
+_MAGIC = 0
+_VERSION = 1
+_SLOTS = 2
+_SLOT_SIZE = 3
+_AUDIO_CAPACITY = 4
+_LATEST = 5
+_AUDIO_LOCK = 6
+_AUDIO_WRITTEN = 7
+_AUDIO_END_SAMPLE = 8
+_AUDIO_END_TIME = 9
+
+# Slot words
+_LOCK = 0
+_SEQUENCE = 1
+_TIMESTAMP = 2
+_WIDTH = 3
+_HEIGHT = 4
+_LENGTH = 5
+
+
+# A frame, as read out of shared memory
+class SharedFrame(NamedTuple):
+    # Read-only (height, width * 2) view of the YUYV framebuffer
+    data: np.ndarray
+    sequence: int
+    timestamp: int
+    width: int
+    height: int
+    # The slot's lock when it was read, see SharedReader.is_intact
+    lock: int
+
+
+# Lays the shared memory out as numpy arrays
+def _map(buffer, slots: int, slot_size: int, audio_capacity: int):
+    header = np.ndarray((_HEADER_WORDS,), dtype=np.uint64, buffer=buffer)
+    offset = header.nbytes
+    meta = np.ndarray(
+        (slots, _SLOT_WORDS), dtype=np.uint64, buffer=buffer, offset=offset
+    )
+    offset += meta.nbytes
+    frames = np.ndarray(
+        (slots, slot_size), dtype=np.uint8, buffer=buffer, offset=offset
+    )
+    offset += frames.nbytes
+    audio = np.ndarray(
+        (audio_capacity,), dtype=np.uint8, buffer=buffer, offset=offset
+    )
+    return header, meta, frames, audio
+
+
+def _size(slots: int, slot_size: int, audio_capacity: int) -> int:
+    words = _HEADER_WORDS + slots * _SLOT_WORDS
+    return 8 * words + slots * slot_size + audio_capacity
+
+
+# Takes frames or audio from the capture, see EasyCAP.attach_frame_consumer
+class _Consumer:
+    def __init__(self, put):
+        self.put = put
+
+    def close(self):
+        pass
+
+
+# Publishes every frame and all the audio of a capture under the given
+# name. Each frame is copied once, on the USB thread, into the next slot.
+# Slots are big enough for any standard, unless slot_size says otherwise.
+class SharedPublisher:
+    def __init__(
+        self,
+        cap,
+        name: str,
+        slots: int = 4,
+        audio_capacity: int = 1 << 20,
+        slot_size: int = None,
+    ):
+        if slots < 2:
+            raise ValueError("Need at least 2 slots, got %d" % slots)
+        self.cap = cap
+        self.name = name
+        self.slots = slots
+        self.slot_size = slot_size or max(
+            standard.frame_size for standard in STANDARDS.values()
+        )
+        self.audio_capacity = audio_capacity
+        self.memory = None
+        # Keeps the memory from going away under a put() in progress
+        self._lock = threading.Lock()
+
+        self._frames = _Consumer(self._put_frame)
+        self._audio = _Consumer(self._put_audio)
+        # Frames too big for a slot
+        self.dropped = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+    def start(self):
+        size = _size(self.slots, self.slot_size, self.audio_capacity)
+        self.memory = shared_memory.SharedMemory(self.name, create=True, size=size)
+        _published.add(self.name)
+        self._header, self._meta, self._slots, self._ring = _map(
+            self.memory.buf, self.slots, self.slot_size, self.audio_capacity
+        )
+        self._header[:] = 0
+        self._meta[:] = 0
+        self._header[_SLOTS] = self.slots
+        self._header[_SLOT_SIZE] = self.slot_size
+        self._header[_AUDIO_CAPACITY] = self.audio_capacity
+        self._header[_VERSION] = VERSION
+        # Last, so readers never see a half initialised header
+        self._header[_MAGIC] = MAGIC
+
+        self.cap.attach_frame_consumer(self._frames)
+        self.cap.attach_audio_consumer(self._audio)
+
+    def stop(self):
+        if self.memory is None:
+            return
+        self.cap.detach_frame_consumer(self._frames)
+        self.cap.detach_audio_consumer(self._audio)
+        with self._lock:
+            # Readers keep their mappings, only the name goes
+            del self._header, self._meta, self._slots, self._ring
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+            _published.discard(self.name)
+
+    # Called by the USB thread with every frame
+    def _put_frame(self, frame):
+        length = len(frame.data)
+        if length > self.slot_size:
+            self.dropped += 1
+            return
+        with self._lock:
+            if self.memory is not None:
+                self._write_frame(frame, length)
+
+    def _write_frame(self, frame, length: int):
+        width = self.cap.size[0]
+        meta = self._meta[frame.sequence % self.slots]
+
+        meta[_LOCK] += 1
+        self._slots[frame.sequence % self.slots, :length] = np.frombuffer(
+            frame.data, dtype=np.uint8
+        )
+        meta[_SEQUENCE] = frame.sequence
+        meta[_TIMESTAMP] = frame.timestamp
+        meta[_WIDTH] = width
+        meta[_HEIGHT] = length // (2 * width)
+        meta[_LENGTH] = length
+        meta[_LOCK] += 1
+
+        self._header[_LATEST] = frame.sequence
+
+    # Called by the audio delivery thread with every chunk
+    def _put_audio(self, chunk: AudioChunk):
+        with self._lock:
+            if self.memory is not None:
+                self._write_audio(chunk)
+
+    def _write_audio(self, chunk: AudioChunk):
+        header = self._header
+        data = np.frombuffer(chunk.data, dtype=np.uint8)
+        count = len(data)
+        written = int(header[_AUDIO_WRITTEN])
+
+        # Anything more than the ring holds would be overwritten anyway
+        data = data[-self.audio_capacity :]
+        start = (written + count - len(data)) % self.audio_capacity
+        first = min(len(data), self.audio_capacity - start)
+
+        header[_AUDIO_LOCK] += 1
+        self._ring[start : start + first] = data[:first]
+        self._ring[: len(data) - first] = data[first:]
+        header[_AUDIO_WRITTEN] = written + count
+        # From the chunk's own index, which counts the samples dropped on
+        # overruns too, so the timeline stays right across them
+        header[_AUDIO_END_SAMPLE] = chunk.sample + count // AUDIO_FRAME_SIZE
+        header[_AUDIO_END_TIME] = chunk.timestamp + (
+            count // AUDIO_FRAME_SIZE * 1000000000 // AUDIO_SAMPLE_RATE
+        )
+        header[_AUDIO_LOCK] += 1
+
+
+# Attaches to a SharedPublisher's memory by name
+class SharedReader:
+    def __init__(self, name: str):
+        self.name = name
+        self.memory = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def open(self):
+        try:
+            self.memory = shared_memory.SharedMemory(self.name, track=False)
+        except TypeError:
+            # Before Python 3.13, attaching also registers the memory to
+            # be unlinked when this process exits, which is the
+            # publisher's job
+            self.memory = shared_memory.SharedMemory(self.name)
+            if self.name not in _published:
+                resource_tracker.unregister(self.memory._name, "shared_memory")
+
+        # Frames are views of this, so the memory is only unmapped once
+        # it, and every frame read out of it, are gone
+        buffer = np.ndarray(
+            (self.memory.size,), dtype=np.uint8, buffer=self.memory.buf
+        )
+        weakref.finalize(buffer, self.memory.close)
+
+        header = buffer[: 8 * _HEADER_WORDS].view(np.uint64)
+        if int(header[_MAGIC]) != MAGIC or int(header[_VERSION]) != VERSION:
+            self.memory = None
+            raise ValueError(
+                "%s isn't a version %d frame ring" % (self.name, VERSION)
+            )
+        self.slots = int(header[_SLOTS])
+        self.slot_size = int(header[_SLOT_SIZE])
+        self.audio_capacity = int(header[_AUDIO_CAPACITY])
+        self._header, self._meta, self._slots, self._ring = _map(
+            buffer, self.slots, self.slot_size, self.audio_capacity
+        )
+        for array in (self._header, self._meta, self._slots, self._ring):
+            array.flags.writeable = False
+
+    def close(self):
+        if self.memory is None:
+            return
+        # The mapping goes with the last frame still held on to
+        self._header = self._meta = self._slots = self._ring = None
+        self.memory = None
+
+    # The sequence number of the latest frame, 0 before the first one
+    @property
+    def latest(self) -> int:
+        return int(self._header[_LATEST])
+
+    # The frame with the given sequence number (by default the latest),
+    # or None if it isn't there (yet, or any more)
+    def read(self, sequence: int = None) -> SharedFrame:
+        if sequence is None:
+            sequence = self.latest
+        meta = self._meta[sequence % self.slots]
+        lock = int(meta[_LOCK])
+        if not sequence or lock & 1 or int(meta[_SEQUENCE]) != sequence:
+            return None
+        timestamp, width, height, length = (
+            int(meta[word]) for word in (_TIMESTAMP, _WIDTH, _HEIGHT, _LENGTH)
+        )
+        if int(meta[_LOCK]) != lock:
+            return None
+        data = self._slots[sequence % self.slots, :length]
+        data = data.reshape(height, width * 2)
+        return SharedFrame(data, sequence, timestamp, width, height, lock)
+
+    # Whether the frame's slot is still as it was when the frame was read.
+    # Check this after using the data, which is a view of the slot.
+    def is_intact(self, frame: SharedFrame) -> bool:
+        return int(self._meta[frame.sequence % self.slots, _LOCK]) == frame.lock
+
+    # Yields frames as they are published, polling every interval seconds,
+    # and skipping any that were overwritten before they could be read
+    def frames(self, interval: float = 0.002):
+        sequence = self.latest
+        while True:
+            latest = self.latest
+            if latest <= sequence:
+                time.sleep(interval)
+                continue
+            # Too far behind, catch up with what's still there
+            sequence = max(sequence + 1, latest - self.slots + 2)
+            frame = self.read(sequence)
+            if frame is not None:
+                yield frame
+
+    # The audio written since position (bytes since the publisher started;
+    # None for wherever it is now), as an AudioChunk, and the position to
+    # read from next. Audio that was overwritten before it could be read is
+    # skipped, and the chunk starts later.
+    def read_audio(self, position: int = None) -> tuple:
+        header = self._header
+        while True:
+            lock = int(header[_AUDIO_LOCK])
+            if lock & 1:
+                continue
+            written = int(header[_AUDIO_WRITTEN])
+            end_time = int(header[_AUDIO_END_TIME])
+            end_sample = int(header[_AUDIO_END_SAMPLE])
+            if position is None:
+                position = written
+            position = max(position, written - self.audio_capacity)
+
+            start = position % self.audio_capacity
+            count = written - position
+            first = min(count, self.audio_capacity - start)
+            data = (
+                self._ring[start : start + first].tobytes()
+                + self._ring[: count - first].tobytes()
+            )
+            if int(header[_AUDIO_LOCK]) == lock:
+                break
+
+        frames = count // AUDIO_FRAME_SIZE
+        timestamp = end_time - frames * 1000000000 // AUDIO_SAMPLE_RATE
+        sample = end_sample - frames
+        return AudioChunk(data, timestamp, sample), written
@@ -0,0 +1,132 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Capture health counters.
+#
+# Everything here is only ever written by the USB thread, and only made of
+# plain ints and fixed-size lists of ints. Under the GIL, reading an int or
+# copying a list is atomic, so snapshot() can be called from any thread
+# without taking a lock on the USB path.
+
+# libusb_transfer_status, in order
+TRANSFER_STATUSES = (
+    "completed",
+    "error",
+    "timed_out",
+    "cancelled",
+    "stall",
+    "no_device",
+    "overflow",
+)
+
+
+# Counts durations in power of two buckets: bucket 0 is under 1us,
+# bucket i is [2^(i-1), 2^i) us, and the last bucket holds everything longer
+class LatencyHistogram:
+    BUCKETS = 24
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+
+    def add(self, duration_ns: int):
+        self.buckets[min((duration_ns // 1000).bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    def snapshot(self) -> dict:
+        buckets = list(self.buckets)
+        return {
+            "count": self.count,
+            "mean_us": self.total_ns / self.count / 1000 if self.count else 0.0,
+            "max_us": self.max_ns / 1000,
+            # Upper bound (in us) of every non-empty bucket, and its count
+            "buckets": {
+                (1 << i): count for i, count in enumerate(buckets) if count
+            },
+        }
+
+
+class CaptureStats:
+    def __init__(self):
+        self.frames_completed = 0
+        # Frames published with some of their packets never received
+        self.frames_incomplete = 0
+        self.packets_missing = 0
+        # Places where a packet was not followed by the next one
+        self.packet_counter_gaps = 0
+        # Completed frames whose frame counter didn't follow the previous one
+        self.frame_counter_gaps = 0
+
+        # Sub-packets without the 0x88 marker
+        self.invalid_markers = 0
+        # Sub-packets with a packet counter that doesn't fit in a frame
+        self.invalid_counters = 0
+        # ISO packets with no data, and with an unexpected amount of data
+        self.empty_packets = 0
+        self.short_packets = 0
+
+        # By libusb transfer status, for whole transfers and ISO packets
+        self.transfer_status = [0] * len(TRANSFER_STATUSES)
+        self.packet_status = [0] * len(TRANSFER_STATUSES)
+        self.resubmit_failures = 0
+        # Transfers currently in flight, and how many times that changed
+        # after the capture started (see tuning.AdaptiveQueue)
+        self.iso_transfers = 0
+        self.iso_resizes = 0
+
+        # Audio periods delivered, transfers dropped because the consumers
+        # were too far behind, and periods that came late
+        self.audio_periods = 0
+        self.audio_overruns = 0
+        self.audio_underruns = 0
+        # Audio transfers by libusb transfer status. Only completed ones
+        # are delivered.
+        self.audio_status = [0] * len(TRANSFER_STATUSES)
+
+        # How long the USB thread spends in each callback
+        self.iso_callback = LatencyHistogram()
+        self.audio_callback = LatencyHistogram()
+        self.frame_handler = LatencyHistogram()
+
+    def snapshot(self) -> dict:
+        transfer_status = list(self.transfer_status)
+        packet_status = list(self.packet_status)
+        audio_status = list(self.audio_status)
+        return {
+            "frames_completed": self.frames_completed,
+            "frames_incomplete": self.frames_incomplete,
+            "packets_missing": self.packets_missing,
+            "packet_counter_gaps": self.packet_counter_gaps,
+            "frame_counter_gaps": self.frame_counter_gaps,
+            "invalid_markers": self.invalid_markers,
+            "invalid_counters": self.invalid_counters,
+            "empty_packets": self.empty_packets,
+            "short_packets": self.short_packets,
+            "transfer_status": dict(zip(TRANSFER_STATUSES, transfer_status)),
+            "packet_status": dict(zip(TRANSFER_STATUSES, packet_status)),
+            "resubmit_failures": self.resubmit_failures,
+            "iso_transfers": self.iso_transfers,
+            "iso_resizes": self.iso_resizes,
+            "audio_periods": self.audio_periods,
+            "audio_overruns": self.audio_overruns,
+            "audio_underruns": self.audio_underruns,
+            "audio_status": dict(zip(TRANSFER_STATUSES, audio_status)),
+            "iso_callback": self.iso_callback.snapshot(),
+            "audio_callback": self.audio_callback.snapshot(),
+            "frame_handler": self.frame_handler.snapshot(),
+        }
@@ -0,0 +1,170 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Audio/video clock drift estimation.
+#
+# The device's audio and video clocks aren't locked to each other, and
+# neither is exactly at its nominal rate. Over an hour, the difference
+# adds up to whole seconds. AVSync measures both against the host's
+# monotonic clock (the timestamps on frames and audio chunks) and tells
+# a muxer or player how to bend the audio to follow the video:
+#
+#   sync = AVSync(cap.standard)
+#   cap.frame_handler = sync.add_frame
+#   cap.audio_handler = lambda chunk: (sync.add_audio(chunk), play(chunk))
+#
+#   sync.drift            # how much faster audio runs than it should (ppm)
+#   sync.resample_ratio   # output samples to produce per input sample
+#   sync.take_correction() # samples to drop (> 0) or duplicate (< 0) now
+
+import math
+import threading
+
+from audio import AUDIO_FRAME_SIZE, AUDIO_SAMPLE_RATE
+from easycap import STANDARDS
+
+
+# Linear fit of a counter against time, with older points weighing
+# exponentially less, so that the rate can follow slow changes
+class RateEstimator:
+    def __init__(self, time_constant: float):
+        self.time_constant = time_constant
+        self.origin = None
+        self.last = None
+        self.count = 0
+        # Weighted sums of 1, t, c, t*t and t*c, t in seconds since origin
+        self._sums = [0.0] * 5
+
+    def add(self, timestamp: int, counter: float):
+        if self.origin is None:
+            self.origin = (timestamp, counter)
+        t = (timestamp - self.origin[0]) / 1e9
+        c = counter - self.origin[1]
+
+        if self.last is not None:
+            decay = math.exp(-(t - self.last) / self.time_constant)
+            self._sums = [s * decay for s in self._sums]
+        self.last = t
+        self.count += 1
+
+        sums = self._sums
+        sums[0] += 1
+        sums[1] += t
+        sums[2] += c
+        sums[3] += t * t
+        sums[4] += t * c
+
+    # Counts per second, or None until there is enough to go on
+    @property
+    def rate(self) -> float:
+        n, t, c, tt, tc = self._sums
+        variance = n * tt - t * t
+        if self.count < 2 or variance <= 0:
+            return None
+        return (n * tc - t * c) / variance
+
+
+class AVSync:
+    # The nominal frame rate comes from the standard. time_constant (in
+    # seconds) is how far back the rate estimates look
+    def __init__(
+        self,
+        standard: str = "NTSC",
+        sample_rate: int = AUDIO_SAMPLE_RATE,
+        time_constant: float = 600.0,
+    ):
+        numerator, denominator = STANDARDS[standard].frame_rate
+        self.frame_rate = numerator / denominator
+        self.sample_rate = sample_rate
+        self.frames = RateEstimator(time_constant)
+        self.audio = RateEstimator(time_constant)
+
+        # Frames handled since the first one, and samples seen by then
+        self._first_frame = None
+        self._last_frame = None
+        # Audio position (sample, timestamp) at the end of the last chunk
+        self._audio_end = None
+        self._audio_at_first_frame = None
+        self._corrected = 0
+
+        # Frames and audio come in on different threads
+        self._lock = threading.Lock()
+
+    # Can be used as a frame_handler
+    def add_frame(self, frame):
+        with self._lock:
+            self.frames.add(frame.timestamp, frame.sequence)
+            if self._first_frame is None and self._audio_end is not None:
+                self._first_frame = frame
+                self._audio_at_first_frame = self._audio_position(frame.timestamp)
+            self._last_frame = frame
+
+    # Can be used as an audio_handler, or called from one
+    def add_audio(self, chunk):
+        with self._lock:
+            samples = len(chunk.data) // AUDIO_FRAME_SIZE
+            self.audio.add(chunk.timestamp, chunk.sample)
+            self._audio_end = (
+                chunk.sample + samples,
+                chunk.timestamp + samples * 1000000000 // self.sample_rate,
+            )
+
+    # The sample being captured at the given time, by the audio clock
+    def _audio_position(self, timestamp: int) -> float:
+        sample, at = self._audio_end
+        rate = self.audio.rate or self.sample_rate
+        return sample + (timestamp - at) / 1e9 * rate
+
+    # How much faster (> 0) or slower (< 0) the audio clock runs than the
+    # video clock, relative to their nominal rates, in parts per million
+    @property
+    def drift(self) -> float:
+        with self._lock:
+            frame_rate = self.frames.rate
+            sample_rate = self.audio.rate
+        if frame_rate is None or sample_rate is None:
+            return 0.0
+        return (
+            (sample_rate / self.sample_rate) / (frame_rate / self.frame_rate) - 1
+        ) * 1e6
+
+    # Audio samples to produce for every captured one, to stay in step
+    # with the video (e.g. for a resampler)
+    @property
+    def resample_ratio(self) -> float:
+        return 1 / (1 + self.drift / 1e6)
+
+    # How many samples ahead (> 0) or behind (< 0) of the video the audio
+    # is, counting from the first frame, less any corrections taken
+    def offset(self) -> float:
+        with self._lock:
+            if self._first_frame is None or self._audio_end is None:
+                return 0.0
+            frame = self._last_frame
+            expected = (
+                (frame.sequence - self._first_frame.sequence)
+                * self.sample_rate
+                / self.frame_rate
+            )
+            captured = (
+                self._audio_position(frame.timestamp) - self._audio_at_first_frame
+            )
+            return captured - expected - self._corrected
+
+    # The whole number of samples to drop (> 0) or duplicate (< 0) right
+    # now to get back in sync. Once taken, a correction isn't given again.
+    def take_correction(self) -> int:
+        correction = int(self.offset())
+        with self._lock:
+            self._corrected += correction
+        return correction
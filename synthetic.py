@@ -0,0 +1,222 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Deterministic, synthetic USB streams, built the same way the device
+# builds them, for benchmarks and for running without a device.
+
+import glob
+import os
+
+import numpy as np
+import usb1 as usb
+from PIL import Image
+
+from audio import AUDIO_SAMPLE_RATE, AUDIO_FRAME_SIZE
+from easycap import (
+    EASYCAP_VIDEO_WIDTH,
+    EASYCAP_VIDEO_HEIGHT,
+    EASYCAP_SUB_PACKETS,
+    EASYCAP_SUB_PACKET_SIZE,
+    EASYCAP_SUB_PACKET_HEADER,
+    EASYCAP_SUB_PACKET_DATA,
+    EASYCAP_PACKET_SIZE,
+    EASYCAP_PACKETS_PER_FIELD,
+    EASYCAP_AUDIO_HEADER,
+    EASYCAP_AUDIO_PADDING,
+)
+
+TEST_IMAGES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_images")
+
+# The device sends a frame every 1/29.97 seconds
+FRAME_INTERVAL_NS = int(1e9 * 1001 / 30000)
+# 256 byte audio transfers
+AUDIO_TRANSFER_SIZE = 256
+AUDIO_INTERVAL_NS = int(
+    1e9
+    * (AUDIO_TRANSFER_SIZE - EASYCAP_AUDIO_HEADER - EASYCAP_AUDIO_PADDING)
+    / AUDIO_FRAME_SIZE
+    / AUDIO_SAMPLE_RATE
+)
+
+
+def test_images() -> list:
+    return sorted(glob.glob(os.path.join(TEST_IMAGES, "*.png")))
+
+
+# Converts an image into a raw framebuffer, exactly as the device would
+# send it: YUYV, with the odd lines (first field) before the even lines
+def image_to_framebuffer(
+    image, size=(EASYCAP_VIDEO_WIDTH, EASYCAP_VIDEO_HEIGHT)
+) -> bytearray:
+    if isinstance(image, str):
+        image = Image.open(image)
+    ycbcr = np.asarray(image.convert("RGB").resize(size).convert("YCbCr"))
+
+    # Pixel pairs share their chroma
+    yuyv = np.empty((size[1], size[0] * 2), dtype=np.uint8)
+    yuyv[:, 0::4] = ycbcr[:, 0::2, 0]
+    yuyv[:, 2::4] = ycbcr[:, 1::2, 0]
+    yuyv[:, 1::4] = (ycbcr[:, 0::2, 1].astype(np.uint16) + ycbcr[:, 1::2, 1]) // 2
+    yuyv[:, 3::4] = (ycbcr[:, 0::2, 2].astype(np.uint16) + ycbcr[:, 1::2, 2]) // 2
+
+    return bytearray(np.concatenate((yuyv[1::2], yuyv[0::2])))
+
+
+# Splits a framebuffer into the sub-packets the device would send for it
+def framebuffer_sub_packets(framebuffer, frame_counter: int = 0) -> np.ndarray:
+    rows = np.frombuffer(framebuffer, dtype=np.uint8).reshape(
+        -1, EASYCAP_SUB_PACKET_DATA
+    )
+    packets_per_field = len(rows) // 2
+
+    sub_packets = np.zeros((len(rows), EASYCAP_SUB_PACKET_SIZE), dtype=np.uint8)
+    counter = np.arange(len(rows)) % packets_per_field
+    interlace = np.arange(len(rows)) // packets_per_field
+    sub_packets[:, 0] = 0x88
+    sub_packets[:, 1] = frame_counter & 0xFF
+    sub_packets[:, 2] = (interlace << 7) | (counter >> 8)
+    sub_packets[:, 3] = counter & 0xFF
+    data = slice(
+        EASYCAP_SUB_PACKET_HEADER, EASYCAP_SUB_PACKET_HEADER + EASYCAP_SUB_PACKET_DATA
+    )
+    sub_packets[:, data] = rows
+    return sub_packets
+
+
+# Yields (packets, lengths) for an endless stream of ISO transfers,
+# cycling through the given framebuffers.
+#
+# Every empty_every-th packet is left empty (0 disables this), as the
+# device does when it has nothing to send.
+def transfers(framebuffers: list, iso_packets: int = 8, empty_every: int = 0):
+    frame_counter = 0
+    packets = np.zeros((iso_packets, EASYCAP_PACKET_SIZE), dtype=np.uint8)
+    lengths = [0] * iso_packets
+    slot = 0
+    sent = 0
+
+    while True:
+        sub_packets = framebuffer_sub_packets(
+            framebuffers[frame_counter % len(framebuffers)], frame_counter
+        ).reshape(-1, EASYCAP_PACKET_SIZE)
+        frame_counter += 1
+
+        for packet in sub_packets:
+            sent += 1
+            if empty_every and sent % empty_every == 0:
+                lengths[slot] = 0
+                slot += 1
+                if slot == iso_packets:
+                    yield packets.copy(), list(lengths)
+                    slot = 0
+
+            packets[slot] = packet
+            lengths[slot] = EASYCAP_PACKET_SIZE
+            slot += 1
+            if slot == iso_packets:
+                yield packets.copy(), list(lengths)
+                slot = 0
+
+
+# Number of ISO transfers it takes to send the given number of frames
+def transfers_per_frames(
+    frames: int,
+    iso_packets: int = 8,
+    empty_every: int = 0,
+    packets_per_field: int = EASYCAP_PACKETS_PER_FIELD,
+) -> int:
+    packets = frames * 2 * packets_per_field // EASYCAP_SUB_PACKETS
+    if empty_every:
+        packets += packets // empty_every
+    return -(-packets // iso_packets)
+
+
+# Writes a synthetic capture file (see replay.py) holding the given number
+# of frames, with timestamps paced like the real device and audio
+# transfers of silence interleaved
+def write_capture(
+    path: str,
+    framebuffers: list,
+    frames: int,
+    iso_packets: int = 8,
+    empty_every: int = 0,
+    audio: bool = True,
+):
+    from replay import TransferRecorder
+
+    packets_per_field = len(framebuffers[0]) // 2 // EASYCAP_SUB_PACKET_DATA
+    count = transfers_per_frames(frames, iso_packets, empty_every, packets_per_field)
+    transfer_interval = FRAME_INTERVAL_NS * frames // count
+    audio_buffer = bytearray(AUDIO_TRANSFER_SIZE)
+
+    with TransferRecorder(path) as recorder:
+        timestamp = 0
+        next_audio = 0
+        stream = transfers(framebuffers, iso_packets, empty_every)
+        for _ in range(count):
+            packets, lengths = next(stream)
+            recorder.write_iso(packets, lengths, timestamp)
+            while audio and next_audio <= timestamp:
+                recorder.write_audio(audio_buffer, next_audio)
+                next_audio += AUDIO_INTERVAL_NS
+            timestamp += transfer_interval
+
+
+# Stands in for a USB transfer, completing as soon as it's submitted
+class FakeTransfer:
+    def __init__(self, handle):
+        self.handle = handle
+        self.status = None
+
+    def setControl(
+        self,
+        request_type,
+        request,
+        value,
+        index,
+        buffer_or_len,
+        callback=None,
+        user_data=None,
+        timeout=0,
+    ):
+        self.control = (request_type, request, value, index, bytes(buffer_or_len))
+        self.callback = callback
+        self.user_data = user_data
+
+    def submit(self):
+        self.handle.controls.append(self.control)
+        index = self.control[3]
+        if index in self.handle.failing:
+            self.status = usb.TRANSFER_ERROR
+        else:
+            self.status = usb.TRANSFER_COMPLETED
+        if self.callback:
+            self.callback(self)
+
+    def getStatus(self):
+        return self.status
+
+    def getUserData(self):
+        return self.user_data
+
+
+# Stands in for a device handle (for protocol.RegisterWriter), recording
+# every control transfer as (request_type, request, value, index, data).
+# Writes to any register in failing fail.
+class FakeDeviceHandle:
+    def __init__(self, failing=()):
+        self.controls = []
+        self.failing = set(failing)
+
+    def getTransfer(self):
+        return FakeTransfer(self)
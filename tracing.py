@@ -0,0 +1,149 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Opt-in tracing of where the time goes, per stage and per thread:
+#
+#   tracing.start()
+#   tracing.dump_on_signal("trace.json")  # kill -USR1 <pid>
+#   ...
+#   tracing.tracer.dump("trace.json")
+#
+# Open the dump in chrome://tracing or https://ui.perfetto.dev to see the
+# USB thread, the audio thread and the main loop side by side.
+#
+# Instrumented code checks the module's tracer before doing anything else,
+# so while tracing is off it costs a global lookup per stage. While it's on,
+# spans go into a ring allocated up front, so only the latest capacity
+# spans are kept, and recording one never allocates.
+
+import functools
+import itertools
+import json
+import os
+import signal
+import threading
+import time
+
+# The Tracer recording spans, or None while tracing is off
+tracer = None
+
+
+class Tracer:
+    def __init__(self, capacity: int = 1 << 16):
+        self.capacity = capacity
+        self._names = [None] * capacity
+        self._starts = [0] * capacity
+        self._ends = [0] * capacity
+        self._threads = [0] * capacity
+        # next() on a count is atomic, so threads never get the same slot
+        self._counter = itertools.count()
+        self._thread_names = {}
+
+    # Records a span of the calling thread, from start to end
+    # (time.perf_counter_ns)
+    def add(self, name: str, start: int, end: int):
+        index = next(self._counter) % self.capacity
+        thread = threading.get_ident()
+        if thread not in self._thread_names:
+            self._thread_names[thread] = threading.current_thread().name
+        self._names[index] = name
+        self._starts[index] = start
+        self._ends[index] = end
+        self._threads[index] = thread
+
+    # The spans still in the ring, oldest first, as (name, thread, start,
+    # end) tuples
+    def spans(self) -> list:
+        spans = zip(self._names, self._threads, self._starts, self._ends)
+        # Spans being recorded right now may be half written
+        return sorted(
+            (span for span in spans if span[0] is not None and span[3] >= span[2]),
+            key=lambda span: span[2],
+        )
+
+    # The spans as a Chrome trace (the JSON object format)
+    def chrome_trace(self) -> dict:
+        pid = os.getpid()
+        events = [
+            {
+                "name": "thread_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": thread,
+                "args": {"name": name},
+            }
+            for thread, name in list(self._thread_names.items())
+        ]
+        for name, thread, start, end in self.spans():
+            events.append(
+                {
+                    "name": name,
+                    "cat": "easycap",
+                    "ph": "X",
+                    "pid": pid,
+                    "tid": thread,
+                    "ts": start / 1000,
+                    "dur": (end - start) / 1000,
+                }
+            )
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def dump(self, path: str):
+        with open(path, "w") as file:
+            json.dump(self.chrome_trace(), file)
+
+
+# Starts tracing into a new ring
+def start(capacity: int = 1 << 16) -> Tracer:
+    global tracer
+    tracer = Tracer(capacity)
+    return tracer
+
+
+# Stops tracing, and returns what was recorded
+def stop() -> Tracer:
+    global tracer
+    stopped, tracer = tracer, None
+    return stopped
+
+
+# Records every call of the decorated function as a span of the given name
+def traced(name: str):
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            active = tracer
+            if active is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                active.add(name, start, time.perf_counter_ns())
+
+        return wrapper
+
+    return decorate
+
+
+# Dumps the trace to path (which goes through time.strftime, so it can
+# hold the time of the dump) whenever the process gets the given signal.
+# Has to be called from the main thread.
+def dump_on_signal(path: str = "trace-%Y%m%d-%H%M%S.json", signum=signal.SIGUSR1):
+    def handler(signum, frame):
+        if tracer is not None:
+            filename = time.strftime(path)
+            tracer.dump(filename)
+            print("Trace written to %s" % filename)
+
+    signal.signal(signum, handler)
@@ -0,0 +1,114 @@
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+# Sizing of the isochronous transfer queue.
+#
+# Every in-flight transfer is a few more milliseconds the USB thread can be
+# late by before the device has nowhere to put its data. Too few and a busy
+# host drops packets, too many and every frame arrives later than it could.
+
+import json
+
+# The device is high speed: one ISO packet per 125us microframe
+MICROFRAME_NS = 125000
+
+# Transfer statuses (see stats.TRANSFER_STATUSES) that mean data was lost.
+# Cancellations are left out, they happen on every exit.
+_ERROR_STATUSES = (1, 2, 4, 6)
+
+
+# Loads settings written by save_settings, as keyword arguments for EasyCAP
+def load_settings(path: str) -> dict:
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_settings(path: str, settings: dict):
+    with open(path, "w") as f:
+        json.dump(settings, f, indent=2)
+
+
+# Picks the number of transfers to keep in flight, from what the capture
+# has seen over the last window:
+# - if data was lost, or the USB thread went quiet for more than half the
+#   time the queue covers, it grows by a quarter
+# - if it has been clean, with callbacks never more than a quarter of the
+#   queue apart, for calm_windows windows in a row, it shrinks by one
+class AdaptiveQueue:
+    def __init__(
+        self,
+        transfers: int,
+        iso_packets: int,
+        minimum: int = 4,
+        maximum: int = 64,
+        window_ns: int = 1000000000,
+        calm_windows: int = 5,
+    ):
+        self.target = transfers
+        self.iso_packets = iso_packets
+        self.minimum = minimum
+        self.maximum = maximum
+        self.window_ns = window_ns
+        self.calm_windows = calm_windows
+
+        self._window_start = None
+        self._last_callback = None
+        # Longest time between two callbacks in this window
+        self._max_interval = 0
+        self._errors = 0
+        self._calm = 0
+
+    @staticmethod
+    def _lost(counters) -> int:
+        return (
+            counters.packet_counter_gaps
+            + counters.frames_incomplete
+            + sum(counters.transfer_status[status] for status in _ERROR_STATUSES)
+            + sum(counters.packet_status[status] for status in _ERROR_STATUSES)
+        )
+
+    # Called on every ISO callback, returns the number of transfers
+    # that should be in flight
+    def update(self, counters, now: int) -> int:
+        if self._last_callback is not None:
+            interval = now - self._last_callback
+            if interval > self._max_interval:
+                self._max_interval = interval
+        self._last_callback = now
+
+        if self._window_start is None:
+            self._window_start = now
+            self._errors = self._lost(counters)
+            return self.target
+        if now - self._window_start < self.window_ns:
+            return self.target
+
+        errors = self._lost(counters)
+        lost = errors - self._errors
+        queue_ns = self.target * self.iso_packets * MICROFRAME_NS
+
+        if lost or self._max_interval > queue_ns // 2:
+            self.target = min(self.maximum, self.target + max(2, self.target // 4))
+            self._calm = 0
+        elif self._max_interval < queue_ns // 4:
+            self._calm += 1
+            if self._calm >= self.calm_windows:
+                self.target = max(self.minimum, self.target - 1)
+                self._calm = 0
+        else:
+            self._calm = 0
+
+        self._window_start = now
+        self._errors = errors
+        self._max_interval = 0
+        return self.target